@@ -0,0 +1,54 @@
+# tcp_workers.py
+#
+# Runs a few tasks on TCP worker processes started on this machine, using the
+# same entry point as workers on other nodes:
+#   python -m kinda.simulation.executors --connect HOST:PORT --authkey KEY
+# Useful as a smoke test of a TCPExecutor setup. Usage:
+#   python tcp_workers.py [num_workers]
+
+import sys
+import math
+import subprocess
+
+from kinda.simulation import executors
+
+num_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+
+#### Listen on localhost (the default) and start the workers
+executor = executors.TCPExecutor()
+host, port = executor.address
+worker_cmd = [sys.executable, '-m', 'kinda.simulation.executors',
+    '--connect', '{}:{}'.format(host, port),
+    '--authkey', executor.authkey,
+    '--processes', str(num_workers)]
+workers = subprocess.Popen(worker_cmd)
+
+connected = executor.wait_for_workers(num_workers, timeout = 30)
+print "Connected workers:", connected
+assert connected == num_workers, "Workers failed to connect"
+
+#### Published objects are sent to each worker before its next task
+executor.publish('message', 'hello from the main process')
+
+tasks = executors.TaskGroup(executor)
+for n in range(10):
+  tasks.submit(math.factorial, n, tag = n)
+tasks.submit(executors.fetch_published, 'message', tag = 'message')
+
+results = {}
+while tasks.pending > 0:
+  tag, result, compute_time, round_trip_time = tasks.next_result()
+  results[tag] = result
+assert all(results[n] == math.factorial(n) for n in range(10))
+assert results['message'] == 'hello from the main process'
+print "Ran {} tasks.".format(len(results))
+
+#### After terminate() the workers exit and the executor refuses new tasks
+executor.terminate()
+workers.wait()
+try:
+  executor.submit(math.factorial, 1, lambda res: None)
+except RuntimeError as err:
+  print "Submitting after terminate():", err
+else:
+  raise AssertionError("submit() after terminate() should fail")
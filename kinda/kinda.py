@@ -5,7 +5,10 @@
 # strand-displacement system properties.
 
 from .statistics import stats_utils
+from .simulation.journal import Journal
+from .simulation.resultcache import ResultCache
 from .objects import io_PIL
+from . import nupack
 import options
   
 
@@ -49,6 +52,9 @@ class System(object):
     self._multistrand_params = dict(options.multistrand_params, **multistrand_params)
     self._nupack_params = dict(options.nupack_params, **nupack_params)
 
+    if self._kinda_params.get('nupack_cache_dir') is not None:
+      nupack.set_cache_directory(self._kinda_params['nupack_cache_dir'])
+
     # Store initial DSD system objects.
     self._condensed_reactions = set(condensed_reactions)
     self._detailed_reactions = set(detailed_reactions)
@@ -74,6 +80,11 @@ class System(object):
     self._spurious_restingsets = None
     self._spurious_condensed_reactions = None
 
+    # Journal of simulation results (see set_journal()), and the journal file and
+    # offset up to which its records are already included in this System.
+    self._journal = None
+    self._journal_position = None
+
     # ok, I changed my mind, let's make stats objects right away ...  but I can
     # still see how one wants to initialize the object, then twiggle some
     # session parameters and *then* make the stats_objects.
@@ -269,6 +280,34 @@ class System(object):
     
     return complexes[0]
 
+  @property
+  def journal(self):
+    return self._journal
+
+  def set_journal(self, filepath, replay = True):
+    """ Appends all Multistrand and NUPACK results obtained from now on to the
+    journal file at filepath, so that they survive a crash between exports.
+    If replay is True, records in the journal that are not yet part of this System
+    are added to it first: for a System imported from a file exported while the
+    same journal was in use, these are the records appended after the export;
+    otherwise, all records. Returns the number of records replayed. """
+    journal = Journal(filepath)
+    num_replayed = 0
+    if replay:
+      start = 0
+      if self._journal_position is not None and self._journal_position[0] == journal.filepath:
+        start = self._journal_position[1]
+      num_replayed = stats_utils.replay_journal(self, journal, start)
+    stats_utils.attach_journal(self, journal)
+    self._journal = journal
+    return num_replayed
+
+  def set_result_cache(self, directory):
+    """ Shares Multistrand results with other sessions through the result cache
+    in directory: jobs without results are first filled with cached results for
+    the same job definition, and new results are added to the cache. """
+    stats_utils.attach_result_cache(self, ResultCache(directory))
+
   def get_stats(self, obj):
     """ Returns the stats object corresponding to the given system object.
     obj must be a resting-set reaction or resting set in the system. """
@@ -15,6 +15,9 @@
 #  defect
 #  sample
 #
+# All but sample are deterministic, and their results are memoized in call_cache
+# (see CallCache).
+#
 # The following functions may be wrapped in a future release:
 #  complexes
 #  concentrations
@@ -26,6 +29,15 @@
 import math
 import subprocess as sub
 import os
+import uuid
+import hashlib
+import inspect
+import tempfile
+import functools
+import contextlib
+import collections
+import cPickle as pickle
+from distutils.spawn import find_executable
 
 def dGadjust(T,N):
     """Adjust NUPACK's native free energy (with reference to mole fraction units) to be appropriate for molar units, assuming N strands in the complex."""
@@ -83,41 +95,65 @@ def setup_nupack_input(**kargs):
   
   return (args, cmd_input)
     
-def call_with_file(args, cmd_input, outsuffix):
-  """ Performs a NUPACK call, returning the lines of the output in a temporary
-  output file. The output file is assumed to have the suffix 'outsuffix'.
+_output_dir = []
+
+def get_output_dir():
+  """ Returns the directory for NUPACK output files: $NUPACK_TMPDIR if set, otherwise
+  /dev/shm if it is a writable directory (RAM-backed on Linux, so that calls do not
+  touch a possibly networked disk), otherwise the default temporary directory. """
+  if not _output_dir:
+    candidates = [os.environ.get('NUPACK_TMPDIR'), '/dev/shm', None]
+    _output_dir.append(next(d for d in candidates
+        if d is None or (os.path.isdir(d) and os.access(d, os.W_OK))))
+  return _output_dir[0]
+
+@contextlib.contextmanager
+def output_file(args, cmd_input, outsuffix):
+  """ Performs a NUPACK call and yields its output file, open for reading, so
+  that callers can parse it line by line. The file is removed afterwards.
+  The output file is assumed to have the suffix 'outsuffix'.
   outsuffix includes the period (.) delimiter.
     Ex:
-      call_with_file(args, input, '.sample')
+      with output_file(args, input, '.sample') as f:
+        header = f.readline()
   """
-  
-  import tempfile
-
   ## Preliminaries
-  # Set up temporary output file
-  outfile = tempfile.NamedTemporaryFile(delete=False, suffix=outsuffix)
-  outprefix = outfile.name[:-len(outsuffix)]
-  
-  # Close the output file so sample can open/write to it.
-  # Will reopen it later to get the output.
-  outfile.close()
-  
-  ## Perform executable call, ignoring pipe output
-  args = [str(s) for s in args] # all argument elements must be strings
-  cmd_input = outprefix + '\n' + cmd_input # prepend the output file prefix to the input for NUPACK
-  p = sub.Popen(args, stdin=sub.PIPE, stdout=sub.PIPE, stderr=sub.STDOUT)
-  p.communicate(cmd_input)
-  
-  ## Process and return output
-  # Read output file and clean it up
-  # Note that it was created by us, so it won't be cleaned up automatically
-  out = open(outfile.name, "rt")
-  output_lines = out.readlines()
-  out.close()
-  os.remove(outfile.name)
-  
-  return output_lines
-  
+  # Reserve the output file name; NUPACK overwrites the file.
+  fd, outname = tempfile.mkstemp(suffix = outsuffix, dir = get_output_dir())
+  os.close(fd)
+  outprefix = outname[:-len(outsuffix)]
+
+  try:
+    ## Perform executable call, ignoring pipe output
+    args = [str(s) for s in args] # all argument elements must be strings
+    cmd_input = outprefix + '\n' + cmd_input # prepend the output file prefix to the input for NUPACK
+    with open(os.devnull, 'w') as devnull:
+      p = sub.Popen(args, stdin=sub.PIPE, stdout=devnull, stderr=sub.STDOUT)
+      p.communicate(cmd_input)
+
+    with open(outname, "rt") as out:
+      yield out
+  finally:
+    # The file was created by us, so it won't be cleaned up automatically
+    try:
+      os.remove(outname)
+    except OSError:
+      pass
+
+def call_with_file(args, cmd_input, outsuffix):
+  """ Performs a NUPACK call, returning the lines of the output in a temporary
+  output file (see output_file()). """
+  with output_file(args, cmd_input, outsuffix) as out:
+    return out.readlines()
+
+def parse_structures(lines):
+  """ Yields (structure, energy) for each dot-paren structure line in an mfe or
+  subopt output file, where the energy is given on the preceding line. """
+  prev = ''
+  for l in lines:
+    if l[0] == '.' or l[0] == '(':
+      yield (l.strip(), prev.strip())
+    prev = l
 
 def call_with_pipe(args, cmd_input):
   """ Performs a NUPACK call, returning the lines of the output from the pipe.
@@ -129,6 +165,177 @@ def call_with_pipe(args, cmd_input):
   output_lines = output.split('\n')
   return (output_lines, error)
     
+# Executables of the memoized functions whose names differ from the function's
+_exec_names = {'defect': 'tubedefect'}
+_installations = {}
+
+def nupack_installation(exec_name):
+  """ Returns a description of the NUPACK installation used to run exec_name: the
+  NUPACKHOME setting, the path, size and modification time of the executable
+  (which change when NUPACK is upgraded or rebuilt), and a digest of the files
+  in the NUPACK parameters directory. """
+  if exec_name not in _installations:
+    path = get_nupack_exec_path(exec_name)
+    if path is not None and os.path.dirname(path) == '':
+      path = find_executable(path)
+    if path is not None and os.path.exists(path):
+      path = os.path.realpath(path)
+      stat = os.stat(path)
+      executable = (path, stat.st_size, stat.st_mtime)
+      bin_dir = os.path.dirname(path)
+      param_dirs = [os.path.join(os.path.dirname(bin_dir), 'parameters'),
+                    os.path.join(os.path.dirname(os.path.dirname(bin_dir)), 'parameters')]
+    else:
+      executable = None
+      param_dirs = []
+    if 'NUPACKHOME' in os.environ:
+      param_dirs.insert(0, os.path.join(os.environ['NUPACKHOME'], 'parameters'))
+
+    params = hashlib.sha1()
+    param_dir = next((d for d in param_dirs if os.path.isdir(d)), None)
+    if param_dir is not None:
+      for filename in sorted(os.listdir(param_dir)):
+        filepath = os.path.join(param_dir, filename)
+        if os.path.isfile(filepath):
+          params.update(filename)
+          with open(filepath, 'rb') as f:
+            params.update(f.read())
+    _installations[exec_name] = (os.environ.get('NUPACKHOME'), executable,
+        param_dir, params.hexdigest())
+  return _installations[exec_name]
+
+class CallCache(object):
+  """ Memoizes the results of deterministic NUPACK calls.
+
+  Results are kept in memory for the max_entries most recently used calls and,
+  if a directory is given, in an on-disk store that may be shared between
+  sessions and processes (entries are written with an atomic rename and never
+  modified). Calls are keyed by a hash of the function name, all of its
+  arguments, with defaults filled in, and the NUPACK installation (see
+  nupack_installation()), so that results are not reused after NUPACK or its
+  parameter files change. hits, disk_hits and misses count the calls
+  answered from memory, from disk, and by running NUPACK.
+  """
+  def __init__(self, max_entries = 4096, directory = None):
+    self.max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self._directory = None
+    self.set_directory(directory)
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+
+  @property
+  def directory(self):
+    return self._directory
+
+  def set_directory(self, directory):
+    """ Sets the directory of the on-disk store, or disables it if directory is None. """
+    if directory is not None:
+      directory = os.path.abspath(directory)
+      if not os.path.isdir(directory):
+        try:
+          os.makedirs(directory)
+        except OSError:
+          if not os.path.isdir(directory):
+            raise
+    self._directory = directory
+
+  @property
+  def enabled(self):
+    return self.max_entries > 0 or self._directory is not None
+
+  @staticmethod
+  def key(func, args, kargs):
+    def canonical(value):
+      if isinstance(value, basestring):
+        return str(value)
+      elif isinstance(value, (list, tuple)):
+        return tuple(canonical(v) for v in value)
+      return value
+    callargs = inspect.getcallargs(func, *args, **kargs)
+    description = (func.__name__, tuple(sorted((k, canonical(v)) for k, v in callargs.iteritems())),
+        nupack_installation(_exec_names.get(func.__name__, func.__name__)))
+    return hashlib.sha1(repr(description)).hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self._directory, key[:2], key + '.pkl')
+
+  def get(self, key):
+    """ Returns (True, result) for a memoized call, or (False, None). """
+    if key in self._entries:
+      self.hits += 1
+      result = self._entries.pop(key)
+      self._entries[key] = result # mark as most recently used
+      return (True, result)
+    if self._directory is not None and os.path.exists(self._path(key)):
+      with open(self._path(key), 'rb') as f:
+        result = pickle.load(f)
+      self.disk_hits += 1
+      self._remember(key, result)
+      return (True, result)
+    self.misses += 1
+    return (False, None)
+
+  def put(self, key, result):
+    self._remember(key, result)
+    if self._directory is not None:
+      path = self._path(key)
+      if not os.path.isdir(os.path.dirname(path)):
+        try:
+          os.makedirs(os.path.dirname(path))
+        except OSError:
+          if not os.path.isdir(os.path.dirname(path)):
+            raise
+      tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+      with open(tmp_path, 'wb') as f:
+        pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+      os.rename(tmp_path, path)
+
+  def _remember(self, key, result):
+    if self.max_entries <= 0:
+      return
+    self._entries[key] = result
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last = False)
+
+  def clear(self):
+    """ Empties the in-memory cache and resets the counts. The on-disk store is kept. """
+    self._entries.clear()
+    self.hits = self.disk_hits = self.misses = 0
+
+  def stats(self):
+    return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+            'entries': len(self._entries)}
+
+call_cache = CallCache(directory = os.environ.get('NUPACK_CACHE_DIR'))
+
+def set_cache_directory(directory):
+  """ Stores memoized NUPACK results in directory (see CallCache). The directory
+  can also be given by the environment variable NUPACK_CACHE_DIR, which is
+  inherited by worker processes. """
+  call_cache.set_directory(directory)
+
+def cache_stats():
+  """ Returns the hit and miss counts of the memoized NUPACK functions. """
+  return call_cache.stats()
+
+def memoized(func):
+  """ Memoizes a deterministic NUPACK function in call_cache. List results are
+  copied, so that callers may modify them. """
+  @functools.wraps(func)
+  def wrapper(*args, **kargs):
+    if not call_cache.enabled:
+      return func(*args, **kargs)
+    key = CallCache.key(func, args, kargs)
+    found, result = call_cache.get(key)
+    if not found:
+      result = func(*args, **kargs)
+      call_cache.put(key, result)
+    return list(result) if isinstance(result, list) else result
+  return wrapper
+
+@memoized
 def pfunc(sequences, ordering = None, material = 'dna',
           dangles = 'some', T = 37, multi = True, pseudo = False,
           sodium = 1.0, magnesium = 0.0):
@@ -156,6 +363,7 @@ def pfunc(sequences, ordering = None, material = 'dna',
   else: return float(output[-3]) + dGadjust(T,len(sequences))
   
   
+@memoized
 def pairs(sequences, ordering = None, material = 'rna',
           dangles = 'some', T = 37, multi = True, pseudo = False,
           sodium = 1.0, magnesium = 0.0, cutoff = 0.001):
@@ -176,19 +384,18 @@ def pairs(sequences, ordering = None, material = 'rna',
   else:
     suffix = '.ppairs'
   
-  ## Perform call
-  output = call_with_file(args, cmd_input, suffix)
-
-  ## Parse and return output
+  ## Perform call, parsing the output as it is read
   pair_probs = []
-  for l in filter(lambda x: x[0].isdigit(), output):
-    if len(l.split()) > 1:
-      i,j,p = l.split()
-      pair_probs.append(tuple( (int(i),int(j),float(p)) ))
+  with output_file(args, cmd_input, suffix) as output:
+    for l in output:
+      if l[0].isdigit() and len(l.split()) > 1:
+        i,j,p = l.split()
+        pair_probs.append(tuple( (int(i),int(j),float(p)) ))
 
   return pair_probs
 
   
+@memoized
 def mfe(sequences, ordering = None, material = 'rna',
         dangles = 'some', T = 37, multi = True, pseudo = False,
         sodium = 1.0, magnesium = 0.0, degenerate = False):
@@ -207,20 +414,12 @@ def mfe(sequences, ordering = None, material = 'rna',
                        dangles = dangles, T = T, multi = multi, pseudo = pseudo)
   if degenerate: args += ['-degenerate']
   
-  ## Perform call
-  output = call_with_file(args, cmd_input, '.mfe')
-
-  ## Parse and return output
-  structs = []
-  for i, l in enumerate(output):
-    if l[0] == '.' or l[0] == '(':
-      s = l.strip()
-      e = output[i-1].strip()
-      structs.append((s,e))
-  
-  return structs
+  ## Perform call, parsing the output as it is read
+  with output_file(args, cmd_input, '.mfe') as output:
+    return list(parse_structures(output))
   
   
+@memoized
 def subopt(sequences, energy_gap, ordering = None, material = 'rna',
            dangles = 'some', T = 37, multi = True, pseudo = False,
            sodium = 1.0, magnesium = 0.0, degenerate = False):
@@ -238,20 +437,12 @@ def subopt(sequences, energy_gap, ordering = None, material = 'rna',
                        dangles = dangles, T = T, multi = multi, pseudo = pseudo)
   cmd_input += '\n' + str(energy_gap)
   
-  ## Perform call
-  output = call_with_file(args, cmd_input, '.subopt')
-
-  ## Parse and return output
-  structs = []
-  for i, l in enumerate(output):
-    if l[0] == '.' or l[0] == '(':
-      s = l.strip()
-      e = output[i-1].strip()
-      structs.append((s,e))
-  
-  return structs
+  ## Perform call, parsing the output as it is read
+  with output_file(args, cmd_input, '.subopt') as output:
+    return list(parse_structures(output))
 
 
+@memoized
 def count(sequences, ordering = None, material = 'rna',
           dangles = 'some', T = 37, multi = True, pseudo = False,
           sodium = 1.0, magnesium = 0.0):
@@ -276,6 +467,7 @@ def count(sequences, ordering = None, material = 'rna',
   return float(output[-2]) # the number of structures can be very large
 
 
+@memoized
 def energy(sequences, structure, ordering = None, material = 'rna',
            dangles = 'some', T = 37, multi = True, pseudo = False,
            sodium = 1.0, magnesium = 0.0):
@@ -303,6 +495,7 @@ def energy(sequences, structure, ordering = None, material = 'rna',
   return float(output[-2])
   
 
+@memoized
 def prob(sequences, structure, ordering = None, material = 'rna',
          dangles = 'some', T = 37, multi = True, pseudo = False,
          sodium = 1.0, magnesium = 0.0):
@@ -330,6 +523,7 @@ def prob(sequences, structure, ordering = None, material = 'rna',
   return float(output[-2])
 
 
+@memoized
 def defect(sequences, structure, ordering = None, material = 'rna',
            dangles = 'some', T = 37, multi = True, pseudo = False,
            sodium = 1.0, magnesium = 0.0, mfe = False):
@@ -379,13 +573,14 @@ def sample(sequences, samples, ordering = None, material = 'rna',
   args += ['-samples', samples]
 
   # Call executable
-  output = call_with_file(args, cmd_input, '.sample')
-
-  # Check NUPACK version
-  if not ("NUPACK 3.0" in output[0] or "NUPACK 3.2" in output[0]):
-    raise IOError("Boltzmann sample function is not up to date. NUPACK 3.2.0 or greater needed.")
-
-  # Parse and return output
-  sampled = [l.strip() for l in output[-samples:]]
+  with output_file(args, cmd_input, '.sample') as output:
+    # Check NUPACK version
+    header = output.readline()
+    if not ("NUPACK 3.0" in header or "NUPACK 3.2" in header):
+      raise IOError("Boltzmann sample function is not up to date. NUPACK 3.2.0 or greater needed.")
+
+    # Parse and return output. The sampled structures are the last lines of the file,
+    # so only those are kept while reading.
+    sampled = [l.strip() for l in collections.deque(output, maxlen = samples)]
   return sampled
 
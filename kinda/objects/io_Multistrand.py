@@ -106,6 +106,57 @@ def to_Multistrand_macrostates(macrostates, ms_complexes):
       for ms in ms_macrostates[m]:  ms.tag = m.name
   return ms_macrostates
   
+class MultistrandContext(object):
+  """Memoizes the conversion of DNAObjects objects to Multistrand objects.
+  Each domain, strand, complex, resting set and macrostate is converted only once,
+  so jobs sharing a context share the same Multistrand objects, and degenerate
+  domains are given the same concrete sequence in all of them.
+  Converted objects must not be modified; see MultistrandJob.setup_ms_params()
+  for how start complexes with job-specific settings are created.
+  """
+  def __init__(self):
+    self._domains = {}
+    self._strands = {}
+    self._complexes = {}
+    self._restingstates = {}
+    self._macrostates = {}
+
+  def to_Multistrand(self, *args, **kargs):
+    """Same as the module-level to_Multistrand(), but only converts objects that
+    were not converted by an earlier call. """
+    from utils import get_dependent_complexes
+
+    ## Extract all objects to be converted
+    macrostates = set(kargs.get('macrostates', []))
+    resting_sets = set(kargs.get('resting_sets', []))
+    complexes = set(sum([get_dependent_complexes(m) for m in macrostates], [])
+                    + sum([list(rs.complexes) for rs in resting_sets], [])
+                    + kargs.get('complexes', []))
+    strands = set(sum([c.strands for c in complexes], [])
+                  + kargs.get('strands', []))
+    domains = set(sum([s.base_domains() for s in strands], [])
+                  + sum([d.base_domains() for d in kargs.get('domains', [])], []))
+
+    ## Convert new objects, in the order of their dependencies
+    self._domains.update(to_Multistrand_domains(
+        [d for d in domains if d not in self._domains]))
+    self._strands.update(to_Multistrand_strands(
+        [s for s in strands if s not in self._strands], self._domains))
+    self._complexes.update(to_Multistrand_complexes(
+        [c for c in complexes if c not in self._complexes], self._strands))
+    self._restingstates.update(to_Multistrand_restingstates(
+        [rs for rs in resting_sets if rs not in self._restingstates], self._complexes))
+    self._macrostates.update(to_Multistrand_macrostates(
+        [m for m in macrostates if m not in self._macrostates], self._complexes))
+
+    def items(converted, objs):
+      return [(obj, converted[obj]) for obj in objs if obj in converted]
+    return {'domains': items(self._domains, domains | set(d.complement for d in domains)),
+            'strands': items(self._strands, strands | set(s.complement for s in strands)),
+            'complexes': items(self._complexes, complexes),
+            'restingstates': items(self._restingstates, resting_sets),
+            'macrostates': items(self._macrostates, macrostates)}
+
 def to_Multistrand(*args, **kargs):
   """Converts DNAObjects objects to Peppercorn objects.
   The following objects will be recognized in the key list and converted:
@@ -119,42 +170,6 @@ def to_Multistrand(*args, **kargs):
   'domains', 'strands', 'complexes', 'resting_sets', and macrostates
   to a list of tuples of the form (object, converted_object). This may be
   iterated through directly or converted into a dict for object lookup.
+  Use a MultistrandContext to share converted objects between calls.
   """
-  import multistrand.objects as MS
-  from macrostate import Macrostate
-  from utils import get_dependent_complexes
-  
-  ## Extract all objects to be converted
-  macrostates = set(kargs.get('macrostates', []))
-  resting_sets = set(kargs.get('resting_sets', []))
-  complexes = set(sum([get_dependent_complexes(m) for m in macrostates], [])
-                  + sum([list(rs.complexes) for rs in resting_sets], [])
-                  + kargs.get('complexes', []))
-  strands = set(sum([c.strands for c in complexes], [])
-                + kargs.get('strands', []))
-  domains = set(sum([s.base_domains() for s in strands], [])
-                + sum([d.base_domains() for d in kargs.get('domains', [])], []))
-
-  ## Create dict of Multistrand Domain objects
-  ms_domains = to_Multistrand_domains(domains)
-    
-  ## Create dict of Multistrand Strand objects
-  ms_strands = to_Multistrand_strands(strands, ms_domains)
-      
-  ## Create dict of Multistrand Complex objects
-  ms_complexes = to_Multistrand_complexes(complexes, ms_strands)
-  
-  ## Create dict of Multistrand RestingState objects
-  ms_restingstates = to_Multistrand_restingstates(resting_sets, ms_complexes)
-  
-  ## Create dict of Multistrand Macrostate objects
-  ms_macrostates = to_Multistrand_macrostates(macrostates, ms_complexes)
-    
-  results = {'domains': ms_domains.items(),
-             'strands': ms_strands.items(),
-             'complexes': ms_complexes.items(),
-             'restingstates': ms_restingstates.items(),
-             'macrostates': ms_macrostates.items()}
-  return results
-    
-  
+  return MultistrandContext().to_Multistrand(*args, **kargs)
@@ -5,6 +5,13 @@ kinda_params = {
   'nupack_similarity_threshold': 0.51,
   'multistrand_multiprocessing': True,
   'nupack_multiprocessing': True,
+  'nupack_cache_dir': None,  # directory of memoized results of deterministic NUPACK calls, if not None
+  'multistrand_cache_dir': None,  # directory of Multistrand results shared between sessions, if not None
+  'multistrand_timeout_quantile': None,  # if not None, calibrate the simulation_time of each reaction to this completion-time quantile
+  'multistrand_timeout_pilot_sims': 200,  # number of simulations used for the calibration
+  'multistrand_max_invalid_records': None,  # if not None, the number of invalid-simulation records kept per reaction
+  'multistrand_invalid_records_policy': 'reservoir',  # may be 'reservoir' (keep a uniform sample) or 'first'
+  'multistrand_sims_per_run': None,  # if not None, the maximum number of simulations per Multistrand run in a worker (default 1000)
   'enable_unimolecular_reactions': False,
   'unimolecular_k1_scale': 1000,  # any value >= 1000 should be sufficient
   'max_concentration': 1e-7  # Provides a default max concentration for each resting set, used for system-level scores
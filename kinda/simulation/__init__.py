@@ -1,4 +1,9 @@
-__all__ = ['multistrandjob',
+__all__ = ['executors',
+           'ffsjob',
+           'journal',
+           'multistrandjob',
            'nupackjob',
+           'resultcache',
+           'scheduler',
            'sim_utils']
           
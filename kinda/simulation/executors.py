@@ -0,0 +1,528 @@
+# executors.py
+#
+# Defines long-lived pools of worker processes that are shared by all
+# simulation jobs, so that worker processes (and the Multistrand/NUPACK state
+# they have loaded) survive from one batch of simulations to the next.
+#
+# Large, immutable task data (e.g. a SimulationSpec) is published to the
+# workers once with Executor.publish() and then referenced by its key, so that
+# the per-task payload stays small. Publications are released with
+# Executor.unpublish() once no more tasks refer to them.
+#
+# Three executors are provided: PoolExecutor (local worker processes),
+# SerialExecutor (runs tasks in the calling process) and TCPExecutor (worker
+# processes that connect over TCP, possibly from other machines). TCP workers
+# are started with
+#   python -m kinda.simulation.executors --connect HOST:PORT --authkey KEY
+
+import os
+import sys
+import time
+import Queue
+import atexit
+import shutil
+import argparse
+import tempfile
+import collections
+import threading
+import traceback
+import cPickle as pickle
+import multiprocessing, signal
+from multiprocessing.connection import Listener, Client
+
+# Objects published to this process, keyed by their publication key.
+# In TCP worker processes this holds the objects received from the TCPExecutor,
+# which are removed when the executor unpublishes them.
+_published = {}
+_published_pickles = {}
+_spool_dir = None
+
+# In pool worker processes, objects loaded from the spool directory, least recently
+# used first. Workers are not told about unpublished objects, so the cache is bounded
+# and evicted objects are loaded again if needed.
+_spool_cache = collections.OrderedDict()
+_SPOOL_CACHE_SIZE = 16
+
+def _init_worker(spool_dir):
+  global _spool_dir
+  _spool_dir = spool_dir
+  # Objects published before the pool was forked are loaded from the spool like any
+  # other, so that they are evicted from the bounded cache as well
+  _published.clear()
+
+def fetch_published(key):
+  """ Returns the object published under the given key. Called in worker processes;
+  the object is unpickled the first time it is requested and cached for subsequent
+  tasks (in pool workers, only the _SPOOL_CACHE_SIZE most recently used). """
+  if key in _published:
+    return _published[key]
+  if key in _published_pickles:
+    _published[key] = pickle.loads(_published_pickles.pop(key))
+    return _published[key]
+
+  obj = _spool_cache.pop(key, None)
+  if obj is None:
+    if _spool_dir is None:
+      raise KeyError("No object is published under {}".format(key))
+    with open(os.path.join(_spool_dir, key), 'rb') as f:
+      obj = pickle.load(f)
+  _spool_cache[key] = obj
+  while len(_spool_cache) > _SPOOL_CACHE_SIZE:
+    _spool_cache.popitem(last = False)
+  return obj
+
+class TaskError(Exception):
+  """ Raised in the main process when a task failed in a worker process.
+  The message holds the worker's traceback. """
+  pass
+
+def _run_task((func, arg)):
+  """ Runs func(arg) in a worker process. Returns a tuple (error, result, elapsed),
+  where error is the formatted traceback if func raised an exception (or None) and
+  elapsed is the wall-clock time spent in func. """
+  start = time.time()
+  try:
+    result, error = func(arg), None
+  except Exception:
+    result, error = None, traceback.format_exc()
+  return (error, result, time.time() - start)
+
+class TaskGroup(object):
+  """ Submits tasks to an executor and returns their results in order of completion.
+  Each result is returned together with the time spent computing it in the worker
+  and the round-trip time seen by the main process, so that callers can estimate
+  the per-task overhead. """
+  def __init__(self, executor):
+    self._executor = executor
+    self._done = Queue.Queue()
+    self.pending = 0
+
+  def submit(self, func, arg, tag = None):
+    """ Schedules func(arg). tag is returned alongside the result. """
+    submit_time = time.time()
+    def callback(res):
+      self._done.put((tag, submit_time, time.time(), res))
+    self._executor.submit(func, arg, callback)
+    self.pending += 1
+
+  def next_result(self):
+    """ Waits for the next finished task and returns a tuple
+    (tag, result, compute_time, round_trip_time). Raises TaskError if the task failed. """
+    while True:
+      # A timeout is needed for the wait to be interruptible by SIGINT
+      try:
+        tag, submit_time, done_time, (error, result, elapsed) = self._done.get(True, 0.5)
+        break
+      except Queue.Empty:
+        pass
+    self.pending -= 1
+    if error is not None:
+      raise TaskError(error)
+    return (tag, result, elapsed, done_time - submit_time)
+
+
+class Executor(object):
+  """ Interface shared by all executors. Jobs only use num_workers, publish(),
+  unpublish(), submit() and terminate(); tasks are normally submitted through a
+  TaskGroup. """
+  @property
+  def num_workers(self):
+    """ The number of tasks that can run concurrently. """
+    raise NotImplementedError
+
+  @property
+  def running(self):
+    """ Whether workers are available now, so that submitted tasks start without
+    first starting worker processes or waiting for workers to connect. """
+    return False
+
+  def publish(self, key, obj):
+    """ Makes obj available to the workers through fetch_published(key).
+    Publishing is done once per key; published objects must not be modified. """
+    raise NotImplementedError
+
+  def unpublish(self, key):
+    """ Releases the object published under key, once no queued or running task
+    refers to it. The key may be published again later. """
+    _published.pop(key, None)
+
+  def submit(self, func, arg, callback):
+    """ Schedules func(arg). callback is called with the tuple returned by
+    _run_task(), possibly from another thread. """
+    raise NotImplementedError
+
+  def terminate(self):
+    """ Stops running tasks as quickly as possible, discarding queued tasks. """
+    pass
+
+  def shutdown(self):
+    """ Releases the executor's workers after queued tasks have finished. """
+    pass
+
+
+class SerialExecutor(Executor):
+  """ Runs each task in the calling process as soon as it is submitted.
+  Useful for debugging, and for machines where worker processes are unavailable. """
+  @property
+  def num_workers(self):
+    return 1
+
+  @property
+  def running(self):
+    return True
+
+  def publish(self, key, obj):
+    _published[key] = obj
+
+  def submit(self, func, arg, callback):
+    callback(_run_task((func, arg)))
+
+
+class PoolExecutor(Executor):
+  """ Wraps a multiprocessing.Pool that is started once, on first use, and is
+  then reused by every job until shutdown() is called.
+
+  Due to a Python bug, SIGINT events (e.g. produced by Ctrl-C) do not cause the worker
+  processes to terminate gracefully. This is resolved by ignoring SIGINT while the
+  worker processes are created, so that all workers ignore SIGINT and the main process
+  can handle it by calling terminate(). A terminated executor is restarted
+  transparently the next time it is used.
+  """
+  def __init__(self, processes = None):
+    if processes is None:
+      processes = multiprocessing.cpu_count()
+    self._processes = processes
+    self._pool = None
+    self._spool_dir = None
+    self._published_keys = set()
+
+  @property
+  def num_workers(self):
+    return self._processes
+
+  @property
+  def running(self):
+    return self._pool is not None
+
+  def start(self):
+    """ Creates the worker processes, if they are not running already. """
+    if self._spool_dir is None:
+      self._spool_dir = tempfile.mkdtemp(prefix = 'kinda-')
+    if self._pool is None:
+      # Temporarily remove the SIGINT event handler
+      sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+      self._pool = multiprocessing.Pool(processes = self._processes,
+          initializer = _init_worker, initargs = (self._spool_dir,))
+
+      # Restore original SIGINT event handler
+      if sigint_handler is None:  sigint_handler = signal.SIG_DFL
+      signal.signal(signal.SIGINT, sigint_handler)
+    return self._pool
+
+  def publish(self, key, obj):
+    if key in self._published_keys:
+      return
+    if self._spool_dir is None:
+      self._spool_dir = tempfile.mkdtemp(prefix = 'kinda-')
+    path = os.path.join(self._spool_dir, key)
+    with open(path + '.tmp', 'wb') as f:
+      pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.tmp', path)
+    _published[key] = obj
+    self._published_keys.add(key)
+
+  def unpublish(self, key):
+    if key not in self._published_keys:
+      return
+    self._published_keys.discard(key)
+    _published.pop(key, None)
+    try:
+      os.remove(os.path.join(self._spool_dir, key))
+    except OSError:
+      pass
+
+  def submit(self, func, arg, callback):
+    """ Schedules func(arg) on a worker process. callback is called in the main process
+    (from a helper thread) with the tuple returned by _run_task(). Use a TaskGroup
+    rather than calling this directly. """
+    self.start().apply_async(_run_task, ((func, arg),), callback = callback)
+
+  def terminate(self):
+    """ Kills the worker processes immediately, discarding any queued tasks.
+    Used to handle SIGINT without waiting for running simulations. """
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool.join()
+      self._pool = None
+
+  def shutdown(self):
+    """ Waits for queued tasks to finish and stops the worker processes. """
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+    self._remove_spool()
+
+  def _remove_spool(self):
+    if self._spool_dir is not None:
+      shutil.rmtree(self._spool_dir, ignore_errors = True)
+      self._spool_dir = None
+      self._published_keys.clear()
+
+
+class TCPExecutor(Executor):
+  """ Runs tasks on worker processes that connect to this executor over TCP, so that
+  one analysis can use the cores of several machines. Workers are started on each
+  machine with
+    python -m kinda.simulation.executors --connect HOST:PORT --authkey KEY --processes N
+  and may connect or disconnect at any time. Each connected worker process runs one
+  task at a time; a task whose worker disconnects is given to another worker.
+  Published objects are sent once to each worker, before its first task that
+  follows the publication, and workers are told to drop unpublished objects before
+  their next task. Workers that connect later only receive the objects that are
+  still published.
+
+  By default the executor only listens on localhost, on a free port. To accept
+  workers from other machines, pass an address such as ('0.0.0.0', port).
+  Connections are authenticated with authkey (see multiprocessing.connection), but
+  not encrypted, so workers should only be run on trusted networks.
+
+  After terminate() the workers have exited and the executor cannot be used again;
+  submit() then raises a RuntimeError instead of queueing tasks that would never run.
+  See examples/tcp_workers.py for a complete example.
+  """
+  def __init__(self, address = ('localhost', 0), authkey = None):
+    if authkey is None:
+      authkey = os.urandom(16).encode('hex')
+    self._address = address
+    self._authkey = authkey
+    self._listener = None
+    self._terminated = False
+    self._tasks = Queue.Queue()
+    self._publications = collections.OrderedDict() # key -> pickled object, in order of publication
+    self._connections = set()
+    self._lock = threading.Lock()
+
+  @property
+  def authkey(self):
+    return self._authkey
+
+  @property
+  def address(self):
+    """ The (host, port) workers should connect to. Starts listening if necessary. """
+    return self.start().address
+
+  @property
+  def num_workers(self):
+    # Report at least one worker, so that tasks are queued until workers connect.
+    with self._lock:
+      return max(1, len(self._connections))
+
+  @property
+  def running(self):
+    with self._lock:
+      return self._listener is not None and len(self._connections) > 0
+
+  def start(self):
+    """ Starts listening for worker connections, if not listening already. """
+    if self._terminated:
+      raise RuntimeError("TCPExecutor was terminated and its workers have exited.")
+    if self._listener is None:
+      self._listener = Listener(self._address, authkey = self._authkey)
+      self._address = self._listener.address
+      thread = threading.Thread(target = self._accept_workers, args = (self._listener, self._tasks))
+      thread.daemon = True
+      thread.start()
+    return self._listener
+
+  def wait_for_workers(self, num_workers, timeout = None):
+    """ Blocks until at least num_workers workers are connected or timeout seconds
+    have passed. Returns the number of connected workers. """
+    self.start()
+    end_time = None if timeout is None else time.time() + timeout
+    while len(self._connections) < num_workers and (end_time is None or time.time() < end_time):
+      time.sleep(0.1)
+    return len(self._connections)
+
+  def _accept_workers(self, listener, tasks):
+    while self._listener is listener:
+      try:
+        conn = listener.accept()
+      except Exception:
+        continue
+      thread = threading.Thread(target = self._serve_worker, args = (conn, tasks))
+      thread.daemon = True
+      thread.start()
+
+  def _serve_worker(self, conn, tasks):
+    with self._lock:
+      self._connections.add(conn)
+    sent = set() # keys of the publications this worker holds
+    try:
+      while True:
+        item = tasks.get()
+        if item is None:
+          conn.send(('stop',))
+          break
+        func, arg, callback = item
+        try:
+          with self._lock:
+            publications = self._publications.items()
+          current = set(key for key, _ in publications)
+          for key in sent - current:
+            conn.send(('unpublish', key))
+          sent &= current
+          for key, data in publications:
+            if key not in sent:
+              conn.send(('publish', key, data))
+              sent.add(key)
+          conn.send(('task', pickle.dumps((func, arg), pickle.HIGHEST_PROTOCOL)))
+          res = conn.recv()
+        except (IOError, EOFError):
+          # Worker disconnected; let another worker run the task
+          tasks.put(item)
+          break
+        callback(res)
+    except (IOError, EOFError):
+      pass
+    finally:
+      with self._lock:
+        self._connections.discard(conn)
+      conn.close()
+
+  def publish(self, key, obj):
+    if key in self._publications:
+      return
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    with self._lock:
+      self._publications[key] = data
+    _published[key] = obj
+
+  def unpublish(self, key):
+    with self._lock:
+      self._publications.pop(key, None)
+    _published.pop(key, None)
+
+  def submit(self, func, arg, callback):
+    self.start()
+    self._tasks.put((func, arg, callback))
+
+  def _stop(self, tasks):
+    listener, self._listener = self._listener, None
+    if listener is not None:
+      listener.close()
+    for _ in range(len(self._connections)):
+      tasks.put(None)
+
+  def terminate(self):
+    """ Discards queued tasks and disconnects all workers; the remote worker processes
+    exit once their current task finishes. The executor cannot be used afterwards. """
+    self._terminated = True
+    tasks, self._tasks = self._tasks, Queue.Queue()
+    while True:
+      try:
+        tasks.get_nowait()
+      except Queue.Empty:
+        break
+    self._stop(tasks)
+    with self._lock:
+      connections = list(self._connections)
+    for conn in connections:
+      conn.close()
+
+  def shutdown(self):
+    """ Tells each worker to exit after the queued tasks have been run. """
+    self._stop(self._tasks)
+
+
+def run_worker(address, authkey):
+  """ Connects to the TCPExecutor at address and runs its tasks until the executor
+  disconnects or tells the worker to stop. """
+  conn = Client(address, authkey = authkey)
+  try:
+    while True:
+      try:
+        msg = conn.recv()
+      except (IOError, EOFError):
+        break
+      if msg[0] == 'publish':
+        _published_pickles[msg[1]] = msg[2]
+      elif msg[0] == 'unpublish':
+        _published_pickles.pop(msg[1], None)
+        _published.pop(msg[1], None)
+      elif msg[0] == 'task':
+        try:
+          func, arg = pickle.loads(msg[1])
+        except Exception:
+          conn.send((traceback.format_exc(), None, 0.0))
+          continue
+        conn.send(_run_task((func, arg)))
+      else:
+        break
+  finally:
+    conn.close()
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+      description = "Run KinDA worker processes for a TCPExecutor.")
+  parser.add_argument('--connect', required = True, metavar = 'HOST:PORT',
+      help = "Address of the TCPExecutor.")
+  parser.add_argument('--authkey', default = os.environ.get('KINDA_AUTHKEY'),
+      help = "Authentication key of the TCPExecutor. Defaults to $KINDA_AUTHKEY.")
+  parser.add_argument('--processes', type = int, default = multiprocessing.cpu_count(),
+      help = "Number of worker processes to start. Defaults to the number of cores.")
+  args = parser.parse_args(argv)
+  if args.authkey is None:
+    parser.error("an authentication key is required")
+
+  host, port = args.connect.rsplit(':', 1)
+  address = (host, int(port))
+  workers = [multiprocessing.Process(target = run_worker, args = (address, args.authkey))
+      for _ in range(args.processes)]
+  for w in workers:
+    w.start()
+  for w in workers:
+    w.join()
+
+
+_default_executor = None
+
+def get_default_executor():
+  """ Returns the module-level executor shared by all simulation jobs, creating a
+  PoolExecutor if necessary. Its workers are stopped automatically at interpreter exit. """
+  global _default_executor
+  if _default_executor is None:
+    set_default_executor(PoolExecutor())
+  return _default_executor
+
+def get_running_executor():
+  """ Returns the shared executor if it exists and its workers are running, or None.
+  Used for optional parallelism that should neither start a worker pool nor wait
+  for workers to connect. """
+  if _default_executor is not None and _default_executor.running:
+    return _default_executor
+  return None
+
+def set_default_executor(executor):
+  """ Replaces the executor used by jobs that were not given one explicitly. """
+  global _default_executor
+  if _default_executor is None:
+    atexit.register(shutdown_default_executor)
+  elif _default_executor is not executor:
+    shutdown_default_executor()
+  _default_executor = executor
+
+def shutdown_default_executor():
+  """ Stops the workers of the shared executor, if it was ever started. """
+  if _default_executor is not None:
+    _default_executor.terminate()
+    if isinstance(_default_executor, PoolExecutor):
+      _default_executor._remove_spool()
+
+
+if __name__ == '__main__':
+  ## Run the workers from the package module rather than __main__, so that
+  ## fetch_published() in tasks sees the objects received by the worker.
+  from kinda.simulation import executors
+  executors.main(sys.argv[1:])
@@ -0,0 +1,192 @@
+# ffsjob.py
+#
+# Defines ForwardFluxJob, which estimates the rate of rare bimolecular reactions
+# (e.g. leak reactions) by forward flux sampling over a sequence of interface
+# macrostates, using the first-step and first-passage Multistrand jobs.
+
+import math
+import random
+import collections
+
+from ..objects import Macrostate
+
+import multistrandjob
+import executors
+
+def count_interfaces(cpx, cutoffs, name = 'interface'):
+  """ Returns COUNT macrostates of the complex cpx for the given fractional defects,
+  ordered from the loosest to the tightest, to be used as FFS interfaces. Each
+  interface requires more of the structure of cpx (e.g. more bound bases of a leak
+  domain) than the one before. """
+  return [Macrostate(name = '{}_{}'.format(name, i + 1), type = 'count', complex = cpx, cutoff = cutoff)
+          for i, cutoff in enumerate(sorted(cutoffs, reverse = True))]
+
+def run_sims_from_global((spec_id, configurations)):
+  """ Multiprocessing function running one simulation from each of the given start
+  configurations (see multistrandjob.configuration_from_end_state()). Simulations
+  from the same configuration are run together. """
+  spec = executors.fetch_published(spec_id)
+  return run_sims_from(spec, configurations)
+
+def run_sims_from(spec, configurations):
+  counts = collections.OrderedDict()
+  for configuration in configurations:
+    counts[configuration] = counts.get(configuration, 0) + 1
+  blocks = [multistrandjob.run_sims(spec, n, start_state = spec.create_start_state(configuration))
+            for configuration, n in counts.iteritems()]
+  return multistrandjob.merge_result_blocks(blocks)
+
+
+class InterfaceStageJob(multistrandjob.FirstPassageTimeModeJob):
+  """ A stage of forward flux sampling: first-passage simulations, each started from
+  a configuration drawn uniformly (with replacement) from those that reached the
+  previous interface, and ending at the next interface or at a failure condition.
+  get_configurations() is called whenever simulations are started, so that
+  configurations found later by the previous stage are used as well.
+
+  Simulations started from the same configuration are correlated, so the error of a
+  statistic is computed as if only min(n, m) independent simulations had been run,
+  where n is the number of simulations and m the number of distinct configurations
+  they were started from. """
+  def __init__(self, start_state, stop_conditions, get_configurations, seed = None, **kargs):
+    super(InterfaceStageJob, self).__init__(start_state, stop_conditions, **kargs)
+    self._get_configurations = get_configurations
+    self._rng = random.Random(seed)
+    self._used_configurations = set()
+
+  @property
+  def num_configurations_used(self):
+    """ The number of distinct configurations simulations were started from. """
+    return len(self._used_configurations)
+
+  def _sample_configurations(self, num_sims):
+    configurations = self._get_configurations()
+    sampled = [self._rng.choice(configurations) for _ in range(num_sims)]
+    self._used_configurations.update(sampled)
+    return sampled
+
+  def get_statistic_error(self, reaction, stat = 'rate'):
+    error = super(InterfaceStageJob, self).get_statistic_error(reaction, stat)
+    n = int(self._results.view('valid').sum())
+    m = self.num_configurations_used
+    if 0 < m < n:
+      error *= math.sqrt(float(n) / m)
+    return error
+
+  def create_task(self, num_sims):
+    return (run_sims_from_global, (self.spec.spec_id, self._sample_configurations(num_sims)))
+
+  def run_sims_locally(self, num_sims):
+    return run_sims_from(self.spec, self._sample_configurations(num_sims))
+
+
+class ForwardFluxJob(object):
+  """ Estimates k1 of a rare bimolecular reaction by forward flux sampling.
+
+  Given interfaces L1, ..., Lm, where Lm is the product macrostate, the first stage
+  runs first-step simulations from the reactants until they reach L1 or a failure
+  condition (e.g. the dissociated reactants), which gives the rate k(L1) at which
+  collisions lead to L1. Stage i then runs first-passage simulations from the end
+  states of the trajectories that reached Li, which gives the probability P(i) of
+  reaching L(i+1) before failing. The rate is
+    k1 = k(L1) * P(1) * ... * P(m-1)
+  and its relative error is the quadrature sum of the relative errors of the stages,
+  where the error of each stage after the first accounts for the correlation of
+  simulations started from the same configuration (see InterfaceStageJob).
+  Each stage only has to resolve a moderate probability, so far fewer trajectories
+  are needed than for estimating a small k1 directly.
+
+  Args:
+    reactants (list): The two reactant resting sets (or complexes).
+    interfaces (list(Macrostate)): The interfaces, ending with the product macrostate.
+      Their names are used as tags and must be unique.
+    failure_conditions (list(Macrostate)): Macrostates that end a trajectory unsuccessfully.
+    boltzmann_selectors (list, optional): Boltzmann selectors of the reactants.
+    seed (optional): Seed for the random choice of start configurations.
+    Other keyword arguments are passed to the Multistrand job of every stage.
+  """
+  def __init__(self, reactants, interfaces, failure_conditions,
+      boltzmann_selectors = None, seed = None, **kargs):
+    assert len(reactants) == 2, "Forward flux sampling requires a bimolecular reaction."
+    # Cached results carry no end states, and the results of later stages depend on
+    # the configurations found by earlier ones, so stages never use a result cache.
+    kargs.pop('result_cache', None)
+    self._interfaces = list(interfaces)
+    self._configurations = [[] for _ in self._interfaces]
+
+    last = len(self._interfaces) - 1
+    self._stages = [multistrandjob.FirstStepModeJob(reactants,
+        [self._interfaces[0]] + list(failure_conditions),
+        boltzmann_selectors = boltzmann_selectors,
+        end_state_tags = [self._interfaces[0].name] if last > 0 else [],
+        **kargs)]
+    for i in range(1, len(self._interfaces)):
+      self._stages.append(InterfaceStageJob(reactants,
+          [self._interfaces[i]] + list(failure_conditions),
+          get_configurations = lambda i = i: self.get_configurations(i - 1),
+          seed = seed if seed is None else seed + i,
+          end_state_tags = [self._interfaces[i].name] if i < last else [],
+          **kargs))
+
+  @property
+  def interfaces(self):
+    return self._interfaces[:]
+
+  @property
+  def stages(self):
+    """ The Multistrand jobs of the stages, starting with the first-step stage. """
+    return self._stages[:]
+
+  @property
+  def total_sims(self):
+    return sum(stage.total_sims for stage in self._stages)
+
+  def get_configurations(self, i):
+    """ Returns the configurations found at interface i (counting from 0). The end
+    states of stage i are converted as they are found and then dropped by the stage. """
+    configurations = self._configurations[i]
+    for _, end_state in self._stages[i].take_end_states():
+      configurations.append(multistrandjob.configuration_from_end_state(end_state))
+    return configurations
+
+  def _stage_stat(self, i):
+    return 'k1' if i == 0 else 'prob'
+
+  def get_stage_statistic(self, i):
+    """ Returns k(L1) for i = 0 and P(i) otherwise. """
+    return self._stages[i].get_statistic(self._interfaces[i].name, self._stage_stat(i))
+  def get_stage_statistic_error(self, i):
+    return self._stages[i].get_statistic_error(self._interfaces[i].name, self._stage_stat(i))
+
+  def get_k1(self):
+    k1 = 1.0
+    for i in range(len(self._stages)):
+      k1 *= self.get_stage_statistic(i)
+    return k1
+  def get_k1_error(self):
+    k1 = self.get_k1()
+    rel_var = 0.0
+    for i in range(len(self._stages)):
+      mean, error = self.get_stage_statistic(i), self.get_stage_statistic_error(i)
+      if mean == 0 or math.isnan(mean) or math.isinf(error):
+        return float('inf')
+      rel_var += (error / mean)**2
+    return abs(k1) * math.sqrt(rel_var)
+
+  def reduce_error_to(self, rel_goal, max_sims_per_stage, verbose = 0, **kargs):
+    """ Runs the stages in order until the error on k1 is below rel_goal*k1. The
+    relative error goal of each stage is rel_goal/sqrt(number of stages), so that the
+    combined goal is met once all stages meet theirs. Each stage runs at most
+    max_sims_per_stage simulations. Other keyword arguments are passed to
+    MultistrandJob.reduce_error_to(). """
+    stage_goal = rel_goal / math.sqrt(len(self._stages))
+    for i, stage in enumerate(self._stages):
+      if verbose:
+        print "# FFS stage {}/{}: {} -> {}".format(i + 1, len(self._stages),
+            'reactants' if i == 0 else self._interfaces[i - 1].name, self._interfaces[i].name)
+      if i > 0 and not self.get_configurations(i - 1):
+        print "KinDA: WARNING: No trajectory reached {}; cannot continue forward flux sampling.".format(
+            self._interfaces[i - 1].name)
+        return
+      stage.reduce_error_to(stage_goal, max_sims_per_stage,
+          reaction = self._interfaces[i].name, stat = self._stage_stat(i), verbose = verbose, **kargs)
@@ -0,0 +1,92 @@
+# journal.py
+#
+# Defines Journal, an append-only binary log of simulation results.
+# Jobs that are given a journal append every block of results as soon as it is
+# processed, so that a crash loses at most the blocks still running, and the
+# journal can be replayed into a System restored from an older export.
+
+import os
+import struct
+import cPickle as pickle
+
+# Each record is a 4-byte little-endian payload length followed by the payload,
+# a pickled tuple (key, data).
+_RECORD_HEADER = struct.Struct('<I')
+
+class Journal(object):
+  """ An append-only file of (key, data) records.
+
+  Records are written with a single write and flushed (and by default fsync-ed)
+  immediately, so that the cost of saving results is proportional to the size of
+  the new results rather than to the size of the whole database. A truncated
+  final record, left by a crash during a write, is ignored when reading and
+  overwritten by the next append.
+  """
+  def __init__(self, filepath, sync = True):
+    self._filepath = os.path.abspath(filepath)
+    self._sync = sync
+    self._file = None
+
+  @property
+  def filepath(self):
+    return self._filepath
+
+  @property
+  def offset(self):
+    """ The position just after the last complete record. Records appended later
+    are read by records(start = offset). """
+    if self._file is None:
+      return self._scan_end()
+    return self._file.tell()
+
+  def _iter_payloads(self, start):
+    # Yields (end_offset, payload) for each complete record at or after start
+    if not os.path.exists(self._filepath):
+      return
+    with open(self._filepath, 'rb') as f:
+      f.seek(start)
+      offset = start
+      while True:
+        header = f.read(_RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size:
+          return
+        (length,) = _RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+          return
+        offset += _RECORD_HEADER.size + length
+        yield (offset, payload)
+
+  def _scan_end(self):
+    end = 0
+    for end, _ in self._iter_payloads(0):
+      pass
+    return end
+
+  def _open(self):
+    if self._file is None:
+      end = self._scan_end()
+      self._file = open(self._filepath, 'r+b' if os.path.exists(self._filepath) else 'w+b')
+      self._file.truncate(end)
+      self._file.seek(end)
+    return self._file
+
+  def append(self, key, data):
+    """ Appends a record. key identifies the job the data belongs to. """
+    f = self._open()
+    payload = pickle.dumps((key, data), pickle.HIGHEST_PROTOCOL)
+    f.write(_RECORD_HEADER.pack(len(payload)) + payload)
+    f.flush()
+    if self._sync:
+      os.fsync(f.fileno())
+
+  def records(self, start = 0):
+    """ Yields the (key, data) records that begin at or after byte offset start,
+    in the order they were appended. """
+    for _, payload in self._iter_payloads(start):
+      yield pickle.loads(payload)
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
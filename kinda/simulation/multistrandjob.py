@@ -6,8 +6,9 @@
 # and processing data relevant to each mode.
 
 import math
+import uuid
 import itertools as it
-import multiprocessing, signal
+import collections
 
 import numpy as np
 
@@ -16,10 +17,17 @@ import multistrand.objects as MSObjects
 from multistrand.options import Options as MSOptions
 from multistrand.options import Literals as MSLiterals
 from multistrand.system import SimSystem as MSSimSystem
+try:
+  from multistrand.interface import Interface as MSInterface
+except ImportError:
+  MSInterface = None
 
 from ..objects import utils, io_Multistrand, Macrostate, RestingSet, Complex
 
 import sim_utils
+import executors
+import scheduler
+import resultcache
 
 # GLOBALS
 TRAJECTORY_MODE = 128
@@ -43,12 +51,289 @@ except AttributeError:
   MS_NOINITIALMOVES = None
   MS_ERROR = None
 
-def run_sims_global((multijob, num_sims)):
+# Per-process cache of MS Options objects by spec id (see get_ms_options()), and
+# the energy model key of the last simulations run in this process.
+_ms_options_cache = collections.OrderedDict()
+_MS_OPTIONS_CACHE_SIZE = 16
+_last_energy_model_key = [None]
+
+# Multistrand keeps the results and end states of all trajectories of a run in
+# memory, so tasks are run as consecutive runs of at most this many simulations
+# whose results are reduced as soon as each run finishes (see run_sims()).
+DEFAULT_SIMS_PER_RUN = 1000
+
+def get_ms_options(spec, num_sims, start_state = None):
+  """Returns an MS Options object running num_sims simulations of the given
+  SimulationSpec. The Options object of a spec is built once per process and then
+  reused, with only num_simulations and the result interface reset, so that the
+  Multistrand start and stop states are not re-derived for every task. No seed is
+  set, so Multistrand still draws fresh seeds for every run.
+  The Multistrand energy model is reused if the previous simulations in this
+  process used the same energy parameters.
+  If start_state (a list of MS Complexes) is given, it replaces the start state of
+  the spec, and a new Options object is built."""
+  if start_state is not None:
+    ms_options = spec.create_ms_options(num_sims, start_state)
+  else:
+    ms_options = _ms_options_cache.pop(spec.spec_id, None)
+    if ms_options is None or MSInterface is None:
+      ms_options = spec.create_ms_options(num_sims)
+    else:
+      ms_options.num_simulations = num_sims
+      ms_options.interface = MSInterface()
+    if MSInterface is not None:
+      _ms_options_cache[spec.spec_id] = ms_options
+      while len(_ms_options_cache) > _MS_OPTIONS_CACHE_SIZE:
+        _ms_options_cache.popitem(last = False)
+
+  if hasattr(ms_options, 'reuse_energymodel'):
+    ms_options.reuse_energymodel = (spec.energy_model_key == _last_energy_model_key[0])
+  _last_energy_model_key[0] = spec.energy_model_key
+  return ms_options
+
+def run_sims(spec, num_sims, start_state = None):
+  """Runs num_sims simulations as described by the given SimulationSpec and
+  returns the results as a result block (see reduce_ms_results()).
+  start_state optionally replaces the start state of the spec (see get_ms_options()).
+  The simulations are run in runs of at most spec.sims_per_run, each reduced into a
+  ResultSink before the next one starts, so that the memory held by Multistrand
+  does not grow with num_sims. All invalid-simulation records are returned; the
+  job's max_invalid_records limit is applied when they are added to the job, so
+  that its InvalidRecordStore sees every record."""
+  sink = ResultSink(num_sims)
+  while True:
+    ms_options = get_ms_options(spec, min(spec.sims_per_run, num_sims - sink.num_sims), start_state)
+    MSSimSystem(ms_options).start()
+    sink.add(reduce_ms_results(spec, ms_options))
+    if MSInterface is not None:
+      ms_options.interface = MSInterface() # release the results of the run
+    if sink.num_sims >= num_sims:
+      return sink.block()
+
+def reduce_ms_results(spec, ms_options):
+  """Reduces the results held by a finished MS Options object to a result block,
+  a dict of fixed-dtype numpy arrays with one entry per simulation:
+    'tags':  int tag id of the stop condition reached (see MultistrandJob.tag_id_dict)
+    'times': simulation time at which the trajectory ended
+    'valid': False for trajectories that timed out or failed
+    'kcoll': collision rate (only if requested by the spec)
+  plus an 'invalid' list of records (dicts) with extra information about the invalid
+  trajectories only. 'simulation_index' in these records is relative to the block.
+  If the spec has end_state_tags, 'end_states' lists (simulation_index, end_state) for
+  the trajectories with these tags. If the spec has transition_state_ids, 'transitions'
+  holds the transitions of all trajectories (see reduce_transition_lists()).
+  The block is much cheaper to send back to the main process than the Options object."""
+  results = ms_options.interface.results
+  n = len(results)
+  tag_ids = spec.tag_ids
+
+  tags = np.fromiter((tag_ids[r.tag] for r in results), dtype = np.int16, count = n)
+  times = np.fromiter((r.time for r in results), dtype = np.float64, count = n)
+  valid = (tags != tag_ids[MS_TIMEOUT]) & (tags != tag_ids[MS_ERROR])
+  block = {'num_sims': n, 'tags': tags, 'times': times, 'valid': valid}
+  if 'kcoll' in spec.result_fields:
+    block['kcoll'] = np.fromiter((r.collision_rate for r in results), dtype = np.float64, count = n)
+
+  ## Store extra information about invalid simulations
+  block['invalid'] = [{
+      'simulation_index': int(i),
+      'end_time': float(times[i]),
+      'type': 'timeout' if tags[i]==tag_ids[MS_TIMEOUT] else 'error',
+      'seed': results[i].seed,
+      'start_structure': results[i].start_state,
+      'end_state': [list(v) for v in ms_options.interface.end_states[i]] # convert tuples to lists
+    } for i in np.flatnonzero(~valid)]
+
+  if spec.end_state_tags:
+    kept = np.in1d(tags, list(spec.end_state_tags))
+    block['end_states'] = [(int(i), [list(v) for v in ms_options.interface.end_states[i]])
+        for i in np.flatnonzero(kept)]
+
+  if spec.transition_state_ids:
+    block['transitions'] = reduce_transition_lists(
+        ms_options.interface.transition_lists, spec.transition_state_ids)
+  return block
+
+def transition_key(start_mask, end_mask, num_states):
+  """Encodes a transition between two sets of states, given as bit masks over the
+  num_states states, as a single integer."""
+  return (start_mask << num_states) | end_mask
+
+def reduce_transition_lists(transition_lists, state_ids):
+  """Reduces Multistrand transition lists, one per trajectory, of the form
+    [[time1, [in_stop_condition1, in_stop_condition2, ...]],
+     [time2, [in_stop_condition1, in_stop_condition2, ...]], ...]
+  to the transitions between the sets of states visited by each trajectory.
+  state_ids gives the state of each stop condition; several stop conditions may
+  belong to the same state. Time points outside of all states are skipped, so each
+  transition goes from one nonempty set of states to the next one.
+  Returns a dict of numpy arrays with one entry per transition:
+    'tags': the transition_key() of the start and end sets of states
+    'times': time between entering the start set and entering the end set
+    'simulation_index': index of the trajectory in transition_lists"""
+  state_ids = np.asarray(state_ids, dtype = np.int64)
+  num_states = int(state_ids.max()) + 1
+  lengths = np.fromiter((len(path) for path in transition_lists), dtype = np.int64,
+      count = len(transition_lists))
+  total = int(lengths.sum())
+
+  times = np.fromiter((t for path in transition_lists for t, _ in path), dtype = np.float64, count = total)
+  in_state = np.array([flags for path in transition_lists for _, flags in path], dtype = np.bool_)
+  in_state = in_state.reshape(total, len(state_ids))
+  masks = np.bitwise_or.reduce(np.where(in_state, np.left_shift(1, state_ids), 0), axis = 1)
+  sims = np.repeat(np.arange(len(lengths)), lengths)
+
+  inside = masks != 0
+  masks, times, sims = masks[inside], times[inside], sims[inside]
+  same_sim = sims[1:] == sims[:-1]
+  return {
+    'tags': transition_key(masks[:-1][same_sim], masks[1:][same_sim], num_states),
+    'times': (times[1:] - times[:-1])[same_sim],
+    'simulation_index': sims[1:][same_sim]
+  }
+
+class ResultSink(object):
+  """Collects consecutive result blocks into a single block, shifting the simulation
+  indices of later blocks. Per-simulation results are copied into arrays allocated
+  once for the expected number of simulations, and invalid-simulation records are
+  kept compressed in a sim_utils.InvalidRecordStore until block() is called."""
+  def __init__(self, expected_sims = 0):
+    self._expected_sims = expected_sims
+    self._results = None
+    self._invalid = sim_utils.InvalidRecordStore()
+    self._end_states = None
+    self._transitions = None
+    self._num_sims = 0
+
+  @property
+  def num_sims(self):
+    return self._num_sims
+
+  def add(self, block):
+    offset = self._num_sims
+    if self._results is None:
+      fields = [k for k in block if k not in ('num_sims', 'invalid', 'end_states', 'transitions')]
+      self._results = sim_utils.ResultStore({k: block[k].dtype for k in fields})
+      self._results.reserve(self._expected_sims)
+    self._results.append(block)
+    self._invalid.extend(block['invalid'], offset)
+    if 'end_states' in block:
+      if self._end_states is None:
+        self._end_states = []
+      self._end_states.extend((i + offset, end_state) for i, end_state in block['end_states'])
+    if 'transitions' in block:
+      if self._transitions is None:
+        self._transitions = sim_utils.ResultStore(
+            {k: v.dtype for k, v in block['transitions'].iteritems()})
+      transitions = block['transitions']
+      self._transitions.append(dict(transitions,
+          simulation_index = transitions['simulation_index'] + offset))
+    self._num_sims += block['num_sims']
+
+  def block(self):
+    """Returns a result block with the results added so far."""
+    block = dict(self._results.views() if self._results is not None else {},
+        num_sims = self._num_sims, invalid = self._invalid.records())
+    if self._end_states is not None:
+      block['end_states'] = self._end_states
+    if self._transitions is not None:
+      block['transitions'] = self._transitions.views()
+    return block
+
+def merge_result_blocks(blocks):
+  """Concatenates result blocks, shifting the simulation indices of their records."""
+  sink = ResultSink(sum(b['num_sims'] for b in blocks))
+  for b in blocks:
+    sink.add(b)
+  return sink.block()
+
+def configuration_from_end_state(end_state):
+  """Converts the end state of a trajectory, as stored in result blocks, to a
+  configuration accepted by SimulationSpec.create_start_state(): a tuple of
+  (sequence, structure) pairs, one per complex, with strands separated by '+'.
+  Assumes the Multistrand layout of end-state complexes
+  (id, strand names, sequence, structure, ...)."""
+  return tuple((str(cpx[2]), str(cpx[3])) for cpx in end_state)
+
+def run_sims_global((spec_id, num_sims)):
   """Multiprocessing function for performing a single simulation.
+  The SimulationSpec is looked up by its id, so it is transferred to each
+  worker process only once.
   """
-  ms_options = multijob.create_ms_options(num_sims)
-  MSSimSystem(ms_options).start()
-  return ms_options
+  return run_sims(executors.fetch_published(spec_id), num_sims)
+
+class SimulationSpec(object):
+  """Immutable description of the simulations performed by a MultistrandJob.
+  Holds only the data needed to create Multistrand Options objects (and none of the
+  collected results), so it can be published once to the worker processes and then
+  referred to by its spec_id."""
+
+  # Options that do not affect the Multistrand energy model
+  _NON_ENERGY_OPTIONS = ('start_state', 'stop_conditions', 'simulation_mode', 'simulation_time',
+      'num_simulations', 'output_interval', 'verbosity')
+
+  def __init__(self, ms_options_dict, boltzmann_selectors = None, tag_ids = {},
+      result_fields = ('tags', 'times', 'valid'), end_state_tags = (), strands = (),
+      transition_state_ids = (), sims_per_run = None):
+    self._spec_id = uuid.uuid4().hex
+    self._ms_options_dict = dict(ms_options_dict)
+    self._boltzmann_selectors = tuple(boltzmann_selectors) if boltzmann_selectors is not None else None
+    self._tag_ids = dict(tag_ids)
+    self._result_fields = tuple(result_fields)
+    self._end_state_tags = frozenset(end_state_tags)
+    self._strands = tuple(strands)
+    self._transition_state_ids = tuple(transition_state_ids)
+    self._sims_per_run = sims_per_run if sims_per_run is not None else DEFAULT_SIMS_PER_RUN
+    self._energy_model_key = repr(sorted((k, v) for k, v in self._ms_options_dict.iteritems()
+        if k not in self._NON_ENERGY_OPTIONS))
+
+  @property
+  def spec_id(self):
+    return self._spec_id
+  @property
+  def ms_options_dict(self):
+    return dict(self._ms_options_dict)
+  @property
+  def boltzmann_selectors(self):
+    return self._boltzmann_selectors
+  @property
+  def tag_ids(self):
+    return self._tag_ids
+  @property
+  def result_fields(self):
+    return self._result_fields
+  @property
+  def end_state_tags(self):
+    """ Tag ids of the trajectories whose end states are returned. """
+    return self._end_state_tags
+  @property
+  def transition_state_ids(self):
+    """ State index of each stop condition, for transition-mode simulations. """
+    return self._transition_state_ids
+  @property
+  def sims_per_run(self):
+    """ Maximum number of simulations per Multistrand run (see run_sims()). """
+    return self._sims_per_run
+  @property
+  def energy_model_key(self):
+    """ Equal for specs whose simulations use the same Multistrand energy model. """
+    return self._energy_model_key
+
+  def create_ms_options(self, num_sims, start_state = None):
+    """ Creates a fresh MS Options object running num_sims simulations, optionally
+    from the given start state instead of the spec's. """
+    options_dict = dict(self._ms_options_dict, num_simulations = num_sims)
+    if start_state is not None:
+      options_dict['start_state'] = start_state
+    return MSOptions(**options_dict)
+
+  def create_start_state(self, configuration):
+    """ Creates MS Complexes for a configuration (see configuration_from_end_state()),
+    using the Multistrand strands of this spec, identified by their sequences. """
+    strands_by_sequence = {str(s.sequence): s for s in self._strands}
+    return [MSObjects.Complex(strands = [strands_by_sequence[seq] for seq in sequence.split('+')],
+                              structure = structure)
+            for sequence, structure in configuration]
 
 # MultistrandJob class definition
 class MultistrandJob(object):
@@ -62,14 +347,42 @@ class MultistrandJob(object):
   def __init__(self, start_state, stop_conditions, sim_mode, 
           boltzmann_selectors = None, 
           multiprocessing = True, 
-          multistrand_params = {}):
+          multistrand_params = {},
+          executor = None,
+          result_cache = None,
+          timeout_quantile = None,
+          timeout_pilot_sims = 200,
+          max_invalid_records = None,
+          invalid_records_policy = 'reservoir',
+          multistrand_context = None,
+          end_state_tags = (),
+          sims_per_run = None):
     self._multistrand_params = dict(multistrand_params)
+    if multistrand_context is None:
+      multistrand_context = io_Multistrand.MultistrandContext()
+    self._multistrand_context = multistrand_context
+    self._end_state_tags = list(end_state_tags)
+    self._end_states = [] # (simulation_index, end_state) of trajectories with end_state_tags
+    self._boltzmann_selectors = boltzmann_selectors
+    self._definition = (list(start_state), list(stop_conditions), sim_mode)
     self._ms_options_dict = self.setup_ms_params(start_state = start_state,
                                           stop_conditions = stop_conditions,
                                           mode = sim_mode,
                                           boltzmann_selectors = boltzmann_selectors)
 
     self._multiprocessing = multiprocessing
+    self._executor = executor
+    self._journal = None
+    self._journal_key = None
+    self._result_cache = result_cache
+    self._cache_loaded = False
+    self._cache_pending = [] # result blocks not yet written to the result cache
+    self._timeout_quantile = timeout_quantile
+    self._timeout_pilot_sims = timeout_pilot_sims
+    self._timeout_calibration = None
+    self._sims_per_run = sims_per_run
+    self._spec = None
+    self._chunk_controller = None
     
     self._stats_funcs = {
         'time': (sim_utils.time_mean, sim_utils.time_std, sim_utils.time_error),
@@ -82,19 +395,17 @@ class MultistrandJob(object):
       MS_ERROR: -3,
       'overall': 0
     }
-    self._ms_results = {
-        'valid': np.array([], dtype=np.int8), 
-        'tags': np.array([], np.int64), 
-        'times': np.array([])
-        }
-    self._ms_results_buff = {
-        'valid': np.array([], dtype=np.int8), 
-        'tags': np.array([], np.int64), 
-        'times': np.array([])
-        }
-    self._ms_results_invalid = [] # extra information about invalid simulations, like timeouts
-
-    self.total_sims = 0
+    self._results = sim_utils.ResultStore({
+        'valid': np.bool_,
+        'tags': np.int16,
+        'times': np.float64
+        })
+    # extra information about invalid simulations, like timeouts
+    self._ms_results_invalid = sim_utils.InvalidRecordStore(max_invalid_records, invalid_records_policy)
+
+  @property
+  def total_sims(self):
+    return len(self._results)
 
   @property
   def multistrand_params(self):
@@ -107,9 +418,43 @@ class MultistrandJob(object):
   def multiprocessing(self, val):
     self._multiprocessing = val
 
+  @property
+  def executor(self):
+    """ The executors.Executor that runs this job's simulations when multiprocessing
+    is on. Defaults to the shared executors.get_default_executor(). """
+    if self._executor is None:
+      return executors.get_default_executor()
+    return self._executor
+  @executor.setter
+  def executor(self, val):
+    self._executor = val
+
   @property
   def tag_id_dict(self):
     return self._tag_id_dict.copy()
+
+  @property
+  def spec(self):
+    """ The SimulationSpec sent to worker processes. Created on first use. """
+    if self._spec is None:
+      self._spec = SimulationSpec(self._ms_options_dict, self._boltzmann_selectors,
+          **self._spec_params())
+    return self._spec
+
+  def unpublish_spec(self):
+    """ Releases the copies of the spec held by the executor and its workers, once
+    no tasks of this job are pending. It is published again when needed. """
+    if self._spec is not None and self._multiprocessing:
+      self.executor.unpublish(self._spec.spec_id)
+
+  def _spec_params(self):
+    # Keyword arguments of the SimulationSpec, extended by subclasses
+    return dict(
+        tag_ids = self._tag_id_dict,
+        result_fields = self._results.columns,
+        end_state_tags = [self._tag_id_dict[tag] for tag in self._end_state_tags],
+        strands = self._ms_strands,
+        sims_per_run = self._sims_per_run)
                                                 
   def setup_ms_params(self, *args, **kargs):
 
@@ -126,24 +471,35 @@ class MultistrandJob(object):
       boltzmann = True
       boltzmann_selectors = kargs['boltzmann_selectors']
 
-    ## Convert DNAObjects to Multistrand objects
-    ms_data = io_Multistrand.to_Multistrand(
+    ## Convert DNAObjects to Multistrand objects. Converted objects are shared
+    ## with the other jobs using the same conversion context.
+    ms_data = self._multistrand_context.to_Multistrand(
         complexes = complexes,
         resting_sets = resting_sets,
         macrostates = stop_conditions
     )
     domains_dict = dict(ms_data['domains'])
     strands_dict = dict(ms_data['strands'])
+    self._ms_strands = list(set(strands_dict.values()))
+    # Concrete sequences, which differ from the strands' for degenerate domains
+    self._strand_sequences = {s: str(ms.sequence) for s, ms in strands_dict.iteritems()}
     complexes_dict = dict(ms_data['complexes'])
     resting_sets_dict = dict(ms_data['restingstates'])
     macrostates_dict = dict(ms_data['macrostates'])
 
-    ms_start_state = [
-            resting_sets_dict[elem]
+    ## The start complexes receive job-specific Boltzmann settings, so each job gets
+    ## its own copies, built from the shared strands. A resting set is represented by
+    ## the same complex as in io_Multistrand.to_Multistrand_restingstates().
+    start_complexes = [
+            iter(elem.complexes).next()
             if (elem in resting_sets_dict)
-            else complexes_dict[elem]
+            else elem
         for elem in kargs['start_state']
     ]
+    ms_start_state = [
+        io_Multistrand.to_Multistrand_complexes([c], strands_dict)[c]
+        for c in start_complexes
+    ]
     ms_stop_conditions = list(it.chain(*[macrostates_dict[m] for m in stop_conditions]))
 
 
@@ -163,142 +519,362 @@ class MultistrandJob(object):
     return options_dict
     
   def get_statistic(self, reaction, stat = 'rate'):
-    return self._stats_funcs[stat][0](self._tag_id_dict[reaction], self._ms_results)
+    return self._stats_funcs[stat][0](self._tag_id_dict[reaction], self._results.views())
   def get_statistic_error(self, reaction, stat = 'rate'):
-    return self._stats_funcs[stat][2](self._tag_id_dict[reaction], self._ms_results)
+    return self._stats_funcs[stat][2](self._tag_id_dict[reaction], self._results.views())
 
   def get_simulation_data(self):
-    return self._ms_results
+    """ Returns a dict of numpy arrays with one entry per simulation. The arrays are
+    views of the job's result store and must not be modified. """
+    return self._results.views()
   def set_simulation_data(self, ms_results):
-    # copy data from ms_results to self._ms_results_buff, while preserving data types of
-    # numpy arrays in self._ms_results_buff
-    for k,v in ms_results.iteritems():
-      self._ms_results_buff[k].resize(len(v), refcheck=False)
-      self._ms_results[k] = self._ms_results_buff[k]
-      if len(v) > 0:
-        np.copyto(self._ms_results_buff[k], v)
-    self.total_sims = len(self._ms_results['tags'])
+    # copy data from ms_results into the result store, converting to the dtypes of its columns
+    self._results.set_data(ms_results)
 
   def add_simulation_data(self, ms_results):
-    # copy data from ms_results to self._ms_results_buff, while preserving data types of
-    # numpy arrays in self._ms_results_buff
-    dim = len(ms_results['tags'])
+    self._results.append(ms_results)
 
-    for k,v in ms_results.iteritems():
-      self._ms_results_buff[k] = np.append(self._ms_results_buff[k], v)
-      self._ms_results[k] = self._ms_results_buff[k]
-    self.total_sims = len(self._ms_results['tags'])
+  @property
+  def end_states(self):
+    """ List of (simulation_index, end_state) for the trajectories that ended with one
+    of the end_state_tags given to the constructor. """
+    return self._end_states[:]
+  def take_end_states(self):
+    """ Returns the end_states and forgets them, so that a caller converting them
+    (e.g. to start configurations) does not keep them in memory twice. """
+    end_states, self._end_states = self._end_states, []
+    return end_states
 
-  def get_invalid_simulation_data(self):
+  @property
+  def invalid_records(self):
+    """ The sim_utils.InvalidRecordStore holding extra information about invalid simulations. """
     return self._ms_results_invalid
+
+  def get_invalid_simulation_data(self):
+    """ Returns the records of invalid simulations as a list of dicts. """
+    return self._ms_results_invalid.records()
   def set_invalid_simulation_data(self, invalid_sim_data):
-    self._ms_results_invalid = invalid_sim_data[:]
+    # invalid_sim_data is a list of records or the columnar form exported by InvalidRecordStore.to_dict()
+    self._ms_results_invalid.set_data(invalid_sim_data)
   
   def create_ms_options(self, num_sims):
     """ Creates a fresh MS Options object using the arguments in self._ms_options_dict. """
-    return MSOptions(**dict(self._ms_options_dict, num_simulations = num_sims))
-
-  def run_simulations(self, num_sims, sims_per_update = 1, sims_per_worker=1, 
-      status_func = lambda:None):
+    return self.spec.create_ms_options(num_sims)
+
+  def create_task(self, num_sims):
+    """ Returns a tuple (func, arg) such that func(arg), called in a worker process,
+    runs num_sims simulations and returns a result block for process_results().
+    The job's spec must have been published to the executor running the task. """
+    return (run_sims_global, (self.spec.spec_id, num_sims))
+
+  def run_sims_locally(self, num_sims):
+    """ Runs num_sims simulations in this process and returns a result block. Does the
+    same as the task returned by create_task(). """
+    return run_sims(self.spec, num_sims)
+
+  def get_chunk_controller(self, num_workers):
+    """ Returns the ChunkSizeController that sizes this job's tasks. The controller
+    is kept with the job so that its timing estimates carry over between batches. """
+    if self._chunk_controller is None:
+      self._chunk_controller = sim_utils.ChunkSizeController(num_workers)
+    return self._chunk_controller
+
+  def run_simulations(self, num_sims, sims_per_update = 1, sims_per_worker = None, 
+      status_func = lambda:None, stop_func = None):
+    """ Runs up to num_sims simulations and returns the number of simulations run.
+    If stop_func is given, it is called whenever new results have been processed and
+    no further simulations are started once it returns True. """
     ## Run simulations using multiprocessing if specified
     if self._multiprocessing:
-      self.run_sims_multiprocessing(num_sims, sims_per_update, sims_per_worker, status_func)
+      return self.run_sims_multiprocessing(num_sims, sims_per_update, sims_per_worker, status_func, stop_func)
     else:
-      self.run_sims_singleprocessing(num_sims, sims_per_update, status_func)
+      return self.run_sims_singleprocessing(num_sims, sims_per_update, status_func, stop_func)
 
-  def run_sims_multiprocessing(self, num_sims, sims_per_update = 1, sims_per_worker = 1, status_func = lambda:None):
+  def run_sims_multiprocessing(self, num_sims, sims_per_update = 1, sims_per_worker = None, 
+      status_func = lambda:None, stop_func = None):
     """
-    Sets up a multiprocessing.Pool object to run simulations concurrently over multiple subprocesses.
-    The Pool object has number of worker processes equal to the number of cpus, as given by
-      multiprocessing.cpu_count()
-    Due to a Python bug, SIGINT events (e.g. produced by Ctrl-C) do not cause the worker processes to terminate
-    gracefully, causing the result-handling loop to hang indefinitely and forcing the main process to be halted
-    externally. This is resolved by removing the SIGINT handler before creating the worker processes, so
-    that all workers ignore SIGINT, allowing the main process to handle SIGINT and terminate them without hanging.
-    The original SIGINT handler is restored immediately after creating the worker processes (otherwise the
-    main process would ignore SIGINT as well). Note that this workaround produces a short time interval in which
-    all SIGINT signals are ignored.
+    Runs simulations concurrently on the workers of self.executor (by default the shared
+    executors.get_default_executor()). The worker processes are created once and
+    reused across batches and jobs, so Multistrand is not re-imported and re-initialized
+    for every batch.
+    Each task runs sims_per_worker simulations. If sims_per_worker is None, the task size
+    is chosen automatically by a sim_utils.ChunkSizeController, based on the measured
+    time per simulation and per-task overhead of this job.
+    If stop_func returns True after a task's results are processed, no more tasks are
+    submitted. Tasks that are already running are still waited for and their results
+    kept, since dropping them would bias the data toward fast trajectories.
+    The worker processes ignore SIGINT, so that the main process can handle SIGINT
+    (e.g. produced by Ctrl-C) and terminate them without hanging. The executor is
+    restarted automatically the next time simulations are requested.
+    Returns the number of simulations run.
     """
-    # Temporarily remove the SIGINT event handler
-    sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-    # Create Pool instance and worker processes
-    k = min(multiprocessing.cpu_count(), num_sims)
-    p = multiprocessing.Pool( processes = k )
+    executor = self.executor
+    executor.publish(self.spec.spec_id, self.spec)
 
-    # Restore original SIGINT event handler
-    if sigint_handler is None:  sigint_handler = signal.SIG_DFL
-    signal.signal(signal.SIGINT, sigint_handler)
-
-    args = [(self, sims_per_worker)] * (num_sims/sims_per_worker)
-    if num_sims%sims_per_worker > 0: args += [(self, num_sims%sims_per_worker)]
-    it = p.imap_unordered(run_sims_global, args)
-    p.close()
+    if sims_per_worker is None:
+      controller = self.get_chunk_controller(executor.num_workers)
+    else:
+      controller = None
+
+    tasks = executors.TaskGroup(executor)
+    stop = [False]
+    def submit_tasks(sims_submitted):
+      # Keep every worker busy, but do not queue tasks behind busy workers, so that
+      # task sizes can still adapt to new timing measurements.
+      while sims_submitted < num_sims and tasks.pending < executor.num_workers and not stop[0]:
+        remaining = num_sims - sims_submitted
+        if controller is not None:
+          n = controller.next_chunk(remaining)
+        else:
+          n = min(sims_per_worker, remaining)
+        func, arg = self.create_task(n)
+        tasks.submit(func, arg, tag = n)
+        sims_submitted += n
+      return sims_submitted
     
     try:
       sims_completed = 0
-      for res in it:
+      sims_submitted = submit_tasks(0)
+      while tasks.pending > 0:
+        n, res, compute_time, round_trip_time = tasks.next_result()
         self.process_results(res)
-
-        sims_completed += len(res.interface.results)
-        if sims_completed % sims_per_update == 0:
-          status_func(sims_completed)
+        if controller is not None:
+          controller.update(n, compute_time, round_trip_time)
+        if stop_func is not None and not stop[0]:
+          stop[0] = stop_func()
+        sims_submitted = submit_tasks(sims_submitted)
+
+        if (sims_completed + n) / sims_per_update > sims_completed / sims_per_update:
+          status_func(sims_completed + n)
+        sims_completed += n
     except KeyboardInterrupt:
       # (More) gracefully handle SIGINT by terminating worker processes properly
       # and then allowing SIGINT to be handled normally
       print "SIGINT: Terminating Multistrand processes prematurely..."
-      p.terminate()
-      p.join()
+      executor.terminate()
       raise KeyboardInterrupt
+    return sims_completed
 
 
-  def run_sims_singleprocessing(self, num_sims, sims_per_update = 1, status_func = None):
+  def run_sims_singleprocessing(self, num_sims, sims_per_update = 1, status_func = None, stop_func = None):
     sims_completed = 0
     while sims_completed < num_sims:
       sims_to_run = min(sims_per_update, num_sims - sims_completed)
 
-      results = run_sims_global((self, sims_to_run))
+      results = self.run_sims_locally(sims_to_run)
       self.process_results(results)
 
       sims_completed += sims_to_run
 
       status_func(sims_completed)
+      if stop_func is not None and stop_func():
+        break
+    return sims_completed
 
   def preallocate_batch(self, batch_size):
-    self._ms_results_buff['valid'].resize(self.total_sims + batch_size, refcheck=False)
-    self._ms_results_buff['tags'].resize(self.total_sims + batch_size, refcheck=False)
-    self._ms_results_buff['times'].resize(self.total_sims + batch_size, refcheck=False)
-    self._ms_results['valid'] = self._ms_results_buff['valid'][:self.total_sims]
-    self._ms_results['tags'] = self._ms_results_buff['tags'][:self.total_sims]
-    self._ms_results['times'] = self._ms_results_buff['times'][:self.total_sims]
+    """ Reserves space for batch_size more results. Space grows geometrically, so
+    calling this for every batch is cheap. """
+    self._results.reserve(self.total_sims + batch_size)
+
+  def set_journal(self, journal, key):
+    """ Appends every result block processed from now on to journal (a journal.Journal),
+    under the given key. Use replay_results() to add journaled blocks to a job. """
+    self._journal = journal
+    self._journal_key = key
+
+  def set_result_cache(self, result_cache):
+    """ Uses result_cache (a resultcache.ResultCache) to pre-load results simulated
+    for the same job definition in earlier sessions, and to store new ones. """
+    self._result_cache = result_cache
+    self._cache_loaded = False
 
-  def process_results(self, ms_options):
-    results = ms_options.interface.results
-    n = len(results)
+  @property
+  def cache_key(self):
+    start_state, stop_conditions, sim_mode = self._definition
+    return resultcache.job_key(start_state, stop_conditions, sim_mode,
+        self._boltzmann_selectors, self._multistrand_params, self._strand_sequences)
+
+  def load_cached_results(self):
+    """ Adds the results found in the result cache for this job's definition, if the
+    job has no results yet (e.g. none were imported or replayed from a journal).
+    Only the first call has an effect. Returns the number of simulations loaded. """
+    if self._result_cache is None or self._cache_loaded:
+      return 0
+    self._cache_loaded = True
+    if self.total_sims > 0:
+      return 0
+    return self._load_cache_entries()
+
+  def _load_cache_entries(self):
+    num_loaded = 0
+    for entry in self._result_cache.load(self.cache_key):
+      # Translate tag names back to this job's tag ids
+      try:
+        tag_ids = {i: self._tag_id_dict[name] for i, name in entry['tag_names'].iteritems()}
+      except KeyError:
+        print "KinDA: WARNING: Skipping cached results with unknown tags."
+        continue
+      results = entry['results']
+      tags = np.empty(len(results['tags']), dtype = np.int16)
+      for i, tag_id in tag_ids.iteritems():
+        tags[results['tags'] == i] = tag_id
+      block = dict(results, tags = tags, num_sims = len(tags),
+          invalid = entry['invalid'])
+
+      self.preallocate_batch(block['num_sims'])
+      self.process_results(block, cache = False)
+      num_loaded += block['num_sims']
+    return num_loaded
+
+  def flush_result_cache(self):
+    """ Writes the results simulated since the last flush to the result cache. """
+    if self._result_cache is None or not self._cache_pending:
+      return
+    blocks, self._cache_pending = self._cache_pending, []
+    results = {k: np.concatenate([b[k] for b in blocks]) for k in self._results.columns}
+    invalid = []
+    offset = 0
+    for b in blocks:
+      for record in b['invalid']:
+        invalid.append(dict(record, simulation_index = record['simulation_index'] + offset))
+      offset += b['num_sims']
+    tag_names = {i: name for name, i in self._tag_id_dict.iteritems()}
+    self._result_cache.store(self.cache_key, tag_names, results, invalid)
 
-    times = [r.time for r in results]
-    tags  = [self._tag_id_dict[r.tag] for r in results]
-    valid = [t!=self._tag_id_dict[MS_TIMEOUT] and t!=self._tag_id_dict[MS_ERROR] for t in tags]
+  @property
+  def timeout_calibration(self):
+    """ None if the simulation time of this job was not calibrated, otherwise a dict:
+      'quantile': the completion-time quantile used as timeout
+      'pilot_sims': number of simulations the quantile was estimated from
+      'base_simulation_time': the simulation time of the pilot simulations
+      'simulation_time': the calibrated simulation time
+      'truncation_prob': estimated probability that a trajectory times out with
+          the calibrated simulation time (the pilot fraction ending after it)
+      'time_bias': relative change of the mean completion time of the pilot
+          trajectories caused by discarding those ending after the calibrated time
+    Statistics are computed from trajectories that finished in time, so truncation_prob
+    and time_bias bound the bias introduced by the shorter timeout. """
+    if self._timeout_calibration is None:
+      return None
+    return dict(self._timeout_calibration)
+  def set_timeout_calibration(self, calibration):
+    """ Restores a calibration previously returned by timeout_calibration. """
+    self._timeout_calibration = dict(calibration)
+    self._set_simulation_time(calibration['simulation_time'])
+
+  def _set_simulation_time(self, simulation_time):
+    # Results simulated with the old timeout belong to a different cache entry.
+    # The calibrated time differs between runs, so later results could never be
+    # found in the cache again and are not written to it.
+    self.flush_result_cache()
+    self._result_cache = None
+    self._multistrand_params['simulation_time'] = simulation_time
+    self._ms_options_dict['simulation_time'] = simulation_time
+    self.unpublish_spec()
+    self._spec = None
+
+  def _truncate_results(self, start):
+    # Counts the results from index start on that ended after the calibrated simulation
+    # time as timeouts, as they would have been if simulated with it, so that results
+    # simulated with a longer time (pilot simulations, or replayed blocks) do not mix
+    # two timeouts.
+    if self._timeout_calibration is None:
+      return
+    simulation_time = self._timeout_calibration['simulation_time']
+    valid = self._results.view('valid')[start:]
+    times = self._results.view('times')[start:]
+    late = np.flatnonzero(valid & (times > simulation_time))
+    if len(late) == 0:
+      return
+    self._results.view('tags')[start:][late] = self._tag_id_dict[MS_TIMEOUT]
+    valid[late] = False
+    times[late] = simulation_time
+    self._ms_results_invalid.extend([{
+        'simulation_index': int(i) + start,
+        'end_time': simulation_time,
+        'type': 'timeout'
+      } for i in late])
+    if self._end_states:
+      late = set(late + start)
+      self._end_states = [(i, end_state) for i, end_state in self._end_states if i not in late]
+
+  def calibrate_simulation_time(self, verbose = 0):
+    """ If the job was created with a timeout_quantile, sets its simulation time to
+    that quantile of the completion times of timeout_pilot_sims pilot simulations,
+    so that trajectories which are very unlikely to finish do not run for the full
+    global simulation time. Pilot simulations are only run if the job has fewer
+    results than that, and are kept, with those ending after the calibrated time
+    counted as timeouts (see _truncate_results()). Only the first call with results
+    to calibrate on has an effect. Returns the timeout_calibration dict, or None. """
+    if self._timeout_quantile is None or self._timeout_calibration is not None:
+      return self._timeout_calibration
+
+    if self.total_sims < self._timeout_pilot_sims:
+      num_pilot = self._timeout_pilot_sims - self.total_sims
+      self.preallocate_batch(num_pilot)
+      self.run_simulations(num_pilot, sims_per_update = num_pilot)
+
+    ## Completion times, with trajectories that timed out or failed counted as never completing
+    base_time = self._multistrand_params.get('simulation_time', float('inf'))
+    valid = self._results.view('valid')
+    times = np.where(valid, self._results.view('times'), np.inf)
+    times.sort()
+    n = len(times)
+    if n == 0:
+      # No pilot simulations (timeout_pilot_sims = 0) and no results yet
+      return None
+    idx = min(n - 1, max(0, int(math.ceil(self._timeout_quantile * n)) - 1))
+    simulation_time = min(times[idx], base_time)
+
+    valid_times = self._results.view('times')[valid]
+    kept_times = valid_times[valid_times <= simulation_time]
+    if len(kept_times) > 0 and valid_times.mean() > 0:
+      time_bias = kept_times.mean() / valid_times.mean() - 1
+    else:
+      time_bias = float('nan')
+    self._timeout_calibration = {
+        'quantile': self._timeout_quantile,
+        'pilot_sims': n,
+        'base_simulation_time': base_time,
+        'simulation_time': float(simulation_time),
+        'truncation_prob': float((times > simulation_time).sum()) / n,
+        'time_bias': float(time_bias)
+    }
+    if simulation_time < base_time:
+      self._set_simulation_time(float(simulation_time))
+      self._truncate_results(0)
 
-    self._ms_results_buff['valid'][self.total_sims:self.total_sims+n] = valid
-    self._ms_results_buff['tags'][self.total_sims:self.total_sims+n] = tags
-    self._ms_results_buff['times'][self.total_sims:self.total_sims+n] = times
+    if verbose:
+      print "#    Calibrated simulation time: {:.4} s ({:.2%} of trajectories truncated, {:+.2%} bias on completion time)".format(
+          simulation_time, self._timeout_calibration['truncation_prob'], time_bias)
+    return self.timeout_calibration
+
+  def replay_results(self, block):
+    """ Adds a result block read back from a journal, without journaling it again. """
+    self.preallocate_batch(block['num_sims'])
+    self._add_results(block)
+
+  def process_results(self, block, cache = True):
+    """ Copies a result block returned by run_sims() into the preallocated result buffers.
+    Unless cache is False, the block is also queued for the result cache. """
+    if self._journal is not None:
+      self._journal.append(self._journal_key, block)
+    if cache and self._result_cache is not None:
+      self._cache_pending.append(block)
+    self._add_results(block)
+
+  def _add_results(self, block):
+    start_ind = self.total_sims
+    self._results.append(block)
 
     ## Store extra information about invalid simulations
-    for i in range(n):
-      if not valid[i]:
-        self._ms_results_invalid.append({
-            'simulation_index': i+self.total_sims,
-            'end_time': times[i],
-            'type': 'timeout' if tags[i]==self._tag_id_dict[MS_TIMEOUT] else 'error',
-            'seed': results[i].seed,
-            'start_structure': results[i].start_state,
-            'end_state': [list(v) for v in ms_options.interface.end_states[i]] # convert tuples to lists
-        })
+    self._ms_results_invalid.extend(block['invalid'], offset = start_ind)
+    self._end_states.extend((i + start_ind, end_state) for i, end_state in block.get('end_states', []))
+    self._truncate_results(start_ind)
 
-    self.total_sims = self.total_sims + n
-    for k in self._ms_results:
-      self._ms_results[k] = self._ms_results_buff[k][:self.total_sims]
+  def _num_successes(self, reaction):
+    # Number of simulations counted as successes for reaction in progress tables
+    return int((self._results.view('tags') == self._tag_id_dict[reaction]).sum())
 
   def reduce_error_to(self, rel_goal, max_sims, 
       reaction = 'overall', 
@@ -307,9 +883,16 @@ class MultistrandJob(object):
       min_batch_size = 50, 
       max_batch_size = 500, 
       sims_per_update = 1, 
-      sims_per_worker = 1,
+      sims_per_worker = None,
+      streaming = True,
       verbose = 0):
     """Stochastic simulations to reduce the error to rel_goal*mean or until max_sims is reached.
+
+    With multiprocessing and streaming enabled (the default), simulations are run
+    without batch barriers: workers are kept busy continuously, the error goal is
+    re-checked as each task finishes, and no further tasks are submitted once it is
+    met (see scheduler.SimulationScheduler). Otherwise simulations are run in
+    synchronous batches whose sizes are re-estimated after each batch.
     
     Args:
       rel_goal (float): The realtive error goal.
@@ -322,6 +905,13 @@ class MultistrandJob(object):
         new error-bars are calculated.  
       max_batch_size (int, optional): Maximum batch size for sampling before 
         new error-bars are calculated.
+      sims_per_update (int, optional): Number of finished simulations between
+        updates of the progress table.
+      sims_per_worker (int, optional): Number of simulations sent to a worker
+        process in a single task. Defaults to None, which adapts the task size
+        to the measured simulation times.
+      streaming (bool, optional): Use the barrier-free mode when multiprocessing
+        is on. Defaults to True.
       verbose (int, optional): Print a progress table. 0: silent mode,
         1: print the rows of a table. 2: print header and rows of a table,
         3: start a new row for every new batch. 4: start a new row whenever
@@ -334,8 +924,8 @@ class MultistrandJob(object):
       # toward fast reactions at runtime ...
       if verbose > 3: inline = False
       total_sims = self.total_sims
-      total_success = (self._ms_results['tags']==self._tag_id_dict[reaction]).sum()
-      total_timeout = total_sims - int((self._ms_results['valid']).sum())
+      total_success = self._num_successes(reaction)
+      total_timeout = total_sims - int((self._results.view('valid')).sum())
       total_failure = total_sims - total_success - total_timeout
 
       if exp_add_sims is None:
@@ -352,9 +942,36 @@ class MultistrandJob(object):
           "est{:4d}%".format(100*total_sims/(total_sims+max(0, exp_add_sims-batch_sims_done)))], inline)
 
     def calc_mean():
-      return self._stats_funcs[stat][0](self._tag_id_dict[reaction], self._ms_results)
+      return self.get_statistic(reaction, stat)
     def calc_error():  
-      return self._stats_funcs[stat][2](self._tag_id_dict[reaction], self._ms_results)
+      return self.get_statistic_error(reaction, stat)
+
+    def print_summary(num_sims, inline):
+      # Show mean, error and the expected number of additional simulations
+      # based on all finished simulations.
+      mean, error = calc_mean(), calc_error()
+      goal = rel_goal * mean
+      total_sims = self.total_sims
+      total_success = self._num_successes(reaction)
+      total_timeout = total_sims - int((self._results.view('valid')).sum())
+      total_failure = total_sims - total_success - total_timeout
+
+      if error == float('inf') or goal == 0.0:
+        table_update_func([mean, error, goal, " |",
+          "{:d}/{:d}".format(num_sims, max_sims), 
+          "{:d}/--".format(total_sims), 
+          "{:d}/{:d}/{:d}".format(total_success, total_failure, total_timeout), 
+          "      {}".format('--')], inline) 
+      else :
+        exp_add_sims = max(0, int(total_sims * ((error/goal)**2 - 1) + 1))
+        table_update_func([mean, error, goal, " |",
+          "{:d}/{:d}".format(num_sims, max_sims), 
+          "{:d}/{:d}".format(total_sims, exp_add_sims), 
+          "{:d}/{:d}/{:d}".format(total_success, total_failure, total_timeout), 
+          "{:7d}%".format(100*total_sims/(total_sims+exp_add_sims))], inline) 
+
+    self.load_cached_results()
+    self.calibrate_simulation_time(verbose = verbose)
 
     num_sims = 0
     error = calc_error()
@@ -364,7 +981,7 @@ class MultistrandJob(object):
     if verbose:
       if verbose > 1:
         if self._multiprocessing:
-          print '#    [MULTIPROCESSING ON] (over %d cores)'%multiprocessing.cpu_count()
+          print '#    [MULTIPROCESSING ON] (over %d cores)'%self.executor.num_workers
         else:
           print '#    [MULTIPROCESSING OFF]'
 
@@ -375,56 +992,61 @@ class MultistrandJob(object):
       table_update_func([mean, error, goal, " |"
         "--/--", "--/--", "--/--/--", "--"])
 
-    while not error < goal and num_sims < max_sims:
-      # Estimate additional trials based on inverse square root relationship
-      # between error and number of trials
-      if self.total_sims == 0 :
-        num_trials = min(max_sims-num_sims, init_batch_size)
-        exp_add_sims = None
-      elif error == float('inf') or goal == 0.0:
-        num_trials = min(max_sims-num_sims, max_batch_size)
-        exp_add_sims = None
-      else:
-        exp_add_sims = int(self.total_sims * ((error / goal)**2 - 1) + 1)
-        num_trials = max(min(max_batch_size, exp_add_sims, self.total_sims + 1), min_batch_size)
-      num_trials = min(num_trials, max_sims - num_sims)
-        
-      self.preallocate_batch(num_trials)
-      self.run_simulations(num_trials, 
-          sims_per_update = sims_per_update, 
-          sims_per_worker = sims_per_worker, 
-          status_func = status_func if verbose else lambda x: None)
-      if verbose:
-        status_func(num_trials, inline=(verbose <= 2))
-
-      num_sims += num_trials
+    if streaming and self._multiprocessing:
+      def progress_func(sim_goal):
+        sims_done = sim_goal.sims_submitted - sim_goal.sims_in_flight
+        if verbose and (sims_done / sims_per_update > progress_func.sims_done / sims_per_update):
+          print_summary(sims_done, inline = (verbose <= 3))
+        progress_func.sims_done = sims_done
+      progress_func.sims_done = 0
+
+      sched = scheduler.SimulationScheduler(
+          executor = self.executor,
+          init_batch_size = init_batch_size,
+          min_batch_size = min_batch_size,
+          max_batch_size = max_batch_size,
+          progress_func = progress_func)
+      sim_goal = sched.add_goal(self, reaction, stat, rel_goal, max_sims, sims_per_worker)
+      sched.run()
+
+      num_sims = sim_goal.sims_submitted
       error = calc_error()
       mean = calc_mean()
       goal = rel_goal * mean
-
-    total_sims = self.total_sims
-    total_success = (self._ms_results['tags']==self._tag_id_dict[reaction]).sum()
-    total_timeout = total_sims - int((self._ms_results['valid']).sum())
-    total_failure = total_sims - total_success - total_timeout
-
-    if error == float('inf') or goal == 0.0:
-      exp_add_sims = None
     else:
-      exp_add_sims = max(0, int(total_sims * ((error/goal)**2 - 1) + 1))
+      while not error < goal and num_sims < max_sims:
+        # Estimate additional trials based on inverse square root relationship
+        # between error and number of trials
+        if self.total_sims == 0 :
+          num_trials = min(max_sims-num_sims, init_batch_size)
+          exp_add_sims = None
+        elif error == float('inf') or goal == 0.0:
+          num_trials = min(max_sims-num_sims, max_batch_size)
+          exp_add_sims = None
+        else:
+          exp_add_sims = int(self.total_sims * ((error / goal)**2 - 1) + 1)
+          num_trials = max(min(max_batch_size, exp_add_sims, self.total_sims + 1), min_batch_size)
+        num_trials = min(num_trials, max_sims - num_sims)
+        
+        self.preallocate_batch(num_trials)
+        sims_run = self.run_simulations(num_trials, 
+            sims_per_update = sims_per_update, 
+            sims_per_worker = sims_per_worker, 
+            status_func = status_func if verbose else lambda x: None,
+            stop_func = lambda: calc_error() < rel_goal * calc_mean())
+        if verbose:
+          status_func(sims_run, inline=(verbose <= 2))
+
+        num_sims += sims_run
+        error = calc_error()
+        mean = calc_mean()
+        goal = rel_goal * mean
+
+    self.flush_result_cache()
+    self.unpublish_spec()
 
     if verbose:
-      if exp_add_sims is None:
-        table_update_func([mean, error, goal, " |",
-          "{:d}/{:d}".format(num_sims, max_sims), 
-          "{:d}/--".format(total_sims), 
-          "{:d}/{:d}/{:d}".format(total_success, total_failure, total_timeout), 
-          "      {}".format('--')], inline=False) 
-      else :
-        table_update_func([calc_mean(), error, goal, " |",
-          "{:d}/{:d}".format(num_sims, max_sims), 
-          "{:d}/{:d}".format(total_sims, exp_add_sims), 
-          "{:d}/{:d}/{:d}".format(total_success, total_failure, total_timeout), 
-          "{:7d}%".format(100*total_sims/(total_sims+exp_add_sims))], inline=False) 
+      print_summary(num_sims, inline=False)
 
 class FirstPassageTimeModeJob(MultistrandJob):
   
@@ -451,129 +1073,104 @@ class FirstPassageTimeModeJob(MultistrandJob):
     )
     self._stats_funcs['k2'] = (sim_utils.uni_k2_mean, sim_utils.uni_k2_std, sim_utils.uni_k2_error)
 
-  
-  def process_results(self, ms_options):
-    results = ms_options.interface.results
-    n = len(results)
-    
-    tags = [self._tag_id_dict[r.tag] for r in results]
-    valid = [t!=self._tag_id_dict[MS_TIMEOUT] and t!=self._tag_id_dict[MS_ERROR] for t in tags]
-    times = [r.time for r in results]
-
-    start_ind, end_ind = self.total_sims, self.total_sims+n
-    self._ms_results_buff['valid'][start_ind:end_ind] = valid
-    self._ms_results_buff['tags'][start_ind:end_ind] = tags
-    self._ms_results_buff['times'][start_ind:end_ind] = times
 
-    ## Store extra information about invalid simulations
-    for i in range(n):
-      if not valid[i]:
-        self._ms_results_invalid.append({
-            'simulation_index': i+self.total_sims,
-            'end_time': times[i],
-            'type': 'timeout' if tags[i]==self._tag_id_dict[MS_TIMEOUT] else 'error',
-            'seed': results[i].seed,
-            'start_structure': results[i].start_state,
-            'end_state': [list(v) for v in ms_options.interface.end_states[i]] # convert tuples to lists
-        })
-
-    self.total_sims = self.total_sims + n
-    for k in self._ms_results:
-      self._ms_results[k] = self._ms_results_buff[k][:self.total_sims]
-      
       
 class TransitionModeJob(MultistrandJob):
-  ## Warning: this class is largely untested  
+  """ Collects the times of transitions between sets of macrostates.
+
+  A trajectory is in the set of macrostates it currently belongs to, and every
+  change between two nonempty sets is a transition. Trajectories end when they
+  reach one of the stop states. Transitions are identified by tags from get_tag(),
+  e.g. 'A->A,B' for a trajectory in macrostate A entering B as well; stop states
+  are referred to as 'stop:' followed by their name.
+  Each set of states is encoded as a bit mask, and transition lists are reduced to
+  arrays of (transition key, time) in the worker processes, with one result row
+  per simulation and a separate store of transitions. Results are not written to
+  a result cache, which only holds per-simulation results.
+  """
   def __init__(self, start_state, macrostates, stop_states, **kargs):
-    stop_conditions = macrostates[:]
-    
-    # This actually modifies the stop macrostates in place, so this could be bad
-    for sc in stop_states:
-      sc.name = "stop:" + sc.name
-      stop_conditions.append(sc)
-      
-    super(TransitionModeJob, self).__init__(start_complex, stop_conditions, TRANSITION_MODE, **kargs)
-      
-    self.states = [sc.tag for sc in self._ms_options_dict['stop_conditions']]
+    stop_conditions = list(macrostates) + list(stop_states)
+    self._stop_state_names = set(sc.name for sc in stop_states)
+    kargs.pop('result_cache', None)
+
+    super(TransitionModeJob, self).__init__(start_state, stop_conditions, TRANSITION_MODE, **kargs)
+
+    self.states = sorted(set(sc.tag for sc in self._ms_options_dict['stop_conditions']))
+    assert 2 * len(self.states) < 64, "Too many macrostates for transition mode."
+    self._state_ids = {s: i for i, s in enumerate(self.states)}
     self._tag_id_dict = {
       MS_TIMEOUT: -1,
       MS_NOINITIALMOVES: -2,
       MS_ERROR: -3,
     }
-    self._tag_id_dict.update((t,i) for i,t in enumerate(sorted(set(self.states))))
-  
-  def get_statistic(self, start_states, end_states, stat = 'rate'):
-    tag = self.get_tag(start_states, end_states)
-    return self._stats_funcs[stat][0](self._tag_id_dict[tag], self._ms_results)
-  def get_statistic_error(self, start_states, end_states, stat = 'rate'):
-    tag = self.get_tag(start_states, end_states)
-    return self._stats_funcs[stat][2](self._tag_id_dict[tag], self._ms_results)
-  
-  def process_results(self, ms_options):
-    results = ms_options.interface.results
-    transition_paths = ms_options.interface.transition_lists
-    
-    tags = [self._tag_id_dict[r.tag] for r in results]
-    valid = [t!=self._tag_id_dict[MS_TIMEOUT] and t!=self._tag_id_dict[MS_ERROR] for t in tags]
-    times = [r.time for r in results]
+    self._tag_id_dict.update(self._state_ids)
 
-    ## Store extra information about invalid simulations
-    for i in range(n):
-      if not valid[i]:
-        self._ms_results_invalid.append({
-            'simulation_index': i+self.total_sims,
-            'end_time': times[i],
-            'type': 'timeout' if tags[i]==self._tag_id_dict[MS_TIMEOUT] else 'error',
-            'seed': results[i].seed,
-            'start_structure': results[i].start_state,
-            'end_state': [list(v) for v in ms_options.interface.end_states[i]] # convert tuples to lists
+    self._transitions = sim_utils.ResultStore({
+        'tags': np.int64,
+        'times': np.float64,
+        'simulation_index': np.int64
         })
- 
-    for path in transition_paths:
-      collapsed_path = collapse_transition_path(path)
-      for start, end in zip(collapsed_path[0:-1], collapsed_path[1:]):
-        time_diff = end[0] - start[0]
-        key_start = ",".join(filter(lambda x: x[1], enumerate(start[1])))
-        key_end = ",".join(filter(lambda x: x[1], enumerate(end[1])))
-        key = key_start + "->" + key_end
-        if key not in self._tag_id_dict:  self._tag_id_dict[key] = len(self._tag_id_dict)
-        tags.append(self._tag_id_dict[key])
-        times.append(time_diff)
-        valid.append(True)
-
-    # Make sure there's enough space
-    self.preallocate_batch(self.total_sims+len(tags) - len(self._ms_results_buff['tags']))
-
-    self._ms_results_buff['valid'][self.total_sims:self.total_sims+len(tags)] = valid
-    self._ms_results_buff['tags'][self.total_sims:self.total_sims+len(tags)] = tags
-    self._ms_results_buff['times'][self.total_sims:self.total_sims+len(times)] = times
-
-    self.total_sims += len(results)
-    for k in self._ms_results:
-      self._ms_results[k] = self._ms_results_buff[k][:self.total_sims]
-    
-  def collapse_transition_path(transition_path):
-    """transition path is a list of the form
-       [[time1, [in_state1, in_state2, ...]]
-        [time2, [in_state1, in_state2, ...]]
-        ...]"""
-    return filter(lambda x: sum(x[1])>0, transition_path)
-    
-  
+
+  def setup_ms_params(self, *args, **kargs):
+    options_dict = super(TransitionModeJob, self).setup_ms_params(*args, **kargs)
+    # Multistrand ends transition-mode trajectories in stop conditions tagged 'stop:'.
+    # The converted Multistrand macrostates may be shared with other jobs, so
+    # the stop states are copied rather than renamed.
+    options_dict['stop_conditions'] = [
+        MSObjects.Macrostate('stop:' + sc.tag, sc.complex_items)
+          if sc.tag in self._stop_state_names else sc
+        for sc in options_dict['stop_conditions']]
+    return options_dict
+
+  def _spec_params(self):
+    params = super(TransitionModeJob, self)._spec_params()
+    params['transition_state_ids'] = [self._state_ids[sc.tag]
+        for sc in self._ms_options_dict['stop_conditions']]
+    return params
+
+  @property
+  def transitions(self):
+    """ Dict of views of the transition store: 'tags', 'times' and 'simulation_index'. """
+    return self._transitions.views()
+
+  def get_tag(self, start_states, end_states):
+    assert all([s in self._state_ids for s in start_states]), "Unknown start state given in %s" % start_states
+    assert all([s in self._state_ids for s in end_states]), "Unknown end state given in %s" % end_states
+    return ",".join(sorted(set(start_states))) + "->" + ",".join(sorted(set(end_states)))
+
+  def _transition_key(self, tag):
+    def state_mask(states):
+      return sum(1 << self._state_ids[s] for s in set(states.split(',')))
+    start_states, end_states = tag.split('->')
+    return transition_key(state_mask(start_states), state_mask(end_states), len(self.states))
+
+  def get_statistic(self, reaction, stat = 'rate'):
+    """ reaction is a transition tag (see get_tag()). """
+    return self._stats_funcs[stat][0](self._transition_key(reaction), self._transitions.views())
+  def get_statistic_error(self, reaction, stat = 'rate'):
+    return self._stats_funcs[stat][2](self._transition_key(reaction), self._transitions.views())
+
+  def get_transition_statistic(self, start_states, end_states, stat = 'rate'):
+    return self.get_statistic(self.get_tag(start_states, end_states), stat)
+  def get_transition_statistic_error(self, start_states, end_states, stat = 'rate'):
+    return self.get_statistic_error(self.get_tag(start_states, end_states), stat)
+
+  def _add_results(self, block):
+    start_ind = self.total_sims
+    super(TransitionModeJob, self)._add_results(block)
+    transitions = block['transitions']
+    self._transitions.append(dict(transitions,
+        simulation_index = transitions['simulation_index'] + start_ind))
+
+  def _num_successes(self, reaction):
+    # Simulations in which the transition occurred
+    transitions = self._transitions.views()
+    selected = transitions['tags'] == self._transition_key(reaction)
+    return len(np.unique(transitions['simulation_index'][selected]))
+
   def reduce_error_to(self, rel_goal, max_sims, start_states, end_states, stat = 'rate', **kwargs):
     super(TransitionModeJob, self).reduce_error_to(rel_goal, max_sims,
         self.get_tag(start_states, end_states), stat, **kwargs)
-    
-  def get_tag(self, start_states, end_states):
-    assert all([s in self.states for s in start_states]), "Unknown start state given in %s" % start_states
-    assert all([s in self.states for s in end_states]), "Unknown end state given in %s" % end_states
-    key_start = ",".join([i for i,s
-                            in enumerate(self.states)
-                            if s in start_states])
-    key_end = ",".join([i for i,s
-                            in enumerate(self.states)
-                            if s in end_states])
-    return key_start + "->" + key_end
 
 
 class FirstStepModeJob(MultistrandJob):
@@ -594,47 +1191,4 @@ class FirstStepModeJob(MultistrandJob):
     self._stats_funcs['k1'] = (sim_utils.k1_mean, sim_utils.k1_std, sim_utils.k1_error)
     self._stats_funcs['k2'] = (sim_utils.k2_mean, sim_utils.k2_std, sim_utils.k2_error)
 
-    self._ms_results['kcoll'] = np.array([])
-    self._ms_results_buff['kcoll'] = np.array([])
-
-  def preallocate_batch(self, batch_size):
-    self._ms_results_buff['valid'].resize(self.total_sims+batch_size, refcheck=False)
-    self._ms_results_buff['tags'].resize(self.total_sims+batch_size, refcheck=False)
-    self._ms_results_buff['times'].resize(self.total_sims+batch_size, refcheck=False)
-    self._ms_results_buff['kcoll'].resize(self.total_sims+batch_size, refcheck=False)
-    self._ms_results['valid'] = self._ms_results_buff['valid'][:self.total_sims]
-    self._ms_results['tags'] = self._ms_results_buff['tags'][:self.total_sims]
-    self._ms_results['times'] = self._ms_results_buff['times'][:self.total_sims]
-    self._ms_results['kcoll'] = self._ms_results_buff['kcoll'][:self.total_sims]
-
-  def process_results(self, ms_options):
-    results = ms_options.interface.results
-    n=len(results)
-
-    tags = [self._tag_id_dict[r.tag] for r in results]
-    valid = [t!=self._tag_id_dict[MS_TIMEOUT] and t!=self._tag_id_dict[MS_ERROR] for t in tags]
-    times = [r.time for r in results]
-    kcolls = [r.collision_rate for r in results]
-    
-    assert len(self._ms_results_buff['tags']) >= self.total_sims+n
-    self._ms_results_buff['valid'][self.total_sims:self.total_sims+n] = valid
-    self._ms_results_buff['tags'][self.total_sims:self.total_sims+n] = tags
-    self._ms_results_buff['times'][self.total_sims:self.total_sims+n] = times
-    self._ms_results_buff['kcoll'][self.total_sims:self.total_sims+n] = kcolls
-
-    ## Store extra information about invalid simulations
-    for i in range(n):
-      if not valid[i]:
-        self._ms_results_invalid.append({
-            'simulation_index': i+self.total_sims,
-            'end_time': times[i],
-            'type': 'timeout' if tags[i]==self._tag_id_dict[MS_TIMEOUT] else 'error',
-            'seed': results[i].seed,
-            'start_structure': results[i].start_state,
-            'end_state': [list(v) for v in ms_options.interface.end_states[i]] # convert tuples to lists
-        })
-
-    self.total_sims += n
-    for k in self._ms_results:
-      self._ms_results[k] = self._ms_results_buff[k][:self.total_sims]
-      
+    self._results.add_column('kcoll', np.float64)
@@ -8,31 +8,22 @@
 
 import sys
 import math
+import bisect
+import collections
 import numpy as np
 
-import multiprocessing, signal
-
 from ..objects import utils, Complex
 from .. import nupack, options
 from sim_utils import print_progress_table
+import executors
 
 
 # NUPACK interface
-def sample_global((self, num_samples)):
-  """ Global function for calling NUPACK, used for multiprocessing  """
-
-  # Set up arguments/options for Nupack call
-  strands = next(iter(self.restingset.complexes)).strands
-  strand_seqs = [strand.sequence for strand in strands]
-
-  # Call Nupack
-  structs = nupack.sample(strand_seqs, num_samples, **self._nupack_params)
-
-  # Convert each Nupack sampled structure (a dot-paren string) into a
-  # DNAObjects Complex object and process.
-  sampled = [Complex(strands = strands, structure = s) for s in structs]
-
-  return sampled
+def sample_global((strand_seqs, nupack_params, num_samples)):
+  """ Global function for calling NUPACK, used for multiprocessing.
+  Returns the sampled structures as dot-paren strings, which are cheaper to send
+  back to the main process than Complex objects. """
+  return nupack.sample(strand_seqs, num_samples, **nupack_params)
 
 class NupackSampleJob(object):
   """Calculate complex probabilities within resting sets using NUPACK.
@@ -45,20 +36,62 @@ class NupackSampleJob(object):
     multiprocessing (bool, optional): Distribute computation to all available
         cores. Defaults to True.
     nupack_params (dict): A dictionary with parameter for NUPACK.
+    executor (executors.Executor, optional): Runs the sampling tasks when
+        multiprocessing is on. Defaults to the shared executor.
+    pool_size (int, optional): Overwrites the class attribute pool_size, the
+        size of a refill of the pool of pre-sampled structures.
 
   Use sample() to request a certain number of secondary structures from the
-  Boltzmann distribution (using Nupack). Use get_complex_prob() to request the
+  Boltzmann distribution (using Nupack). Structures are drawn from a pool that is
+  refilled by a few large NUPACK calls, see fill_pool(). Use get_complex_prob() to request the
   probability estimate for a particular complex. To update results for a new
   similarity threshold use set_similarity_threshold().
   """
 
   verbose = 1
 
+  # Number of structures sampled whenever the pool of pre-sampled structures runs
+  # empty. Every NUPACK call computes the partition function of the resting set
+  # before drawing its samples, so the pool is refilled by a few large calls and
+  # the structures left over by one batch are used by the next.
+  pool_size = 5000
+
+  # Minimum number of structures drawn by one NUPACK call when a refill is split
+  # between worker processes.
+  min_samples_per_call = 1000
+
+  # Number of structures taken from the pool between checks of an error goal.
+  samples_per_update = 50
+
+  # Number of times a structure must have been sampled to be used by
+  # get_top_MFE_structs() when answering from the sampled structures.
+  min_sample_count = 20
+
+  # Maximum number of frequently sampled structures whose energies are computed
+  # (one NUPACK call each) by get_top_MFE_structs(). With more, a single subopt
+  # call is cheaper.
+  max_energy_calls = 40
+
   def __init__(self, restingset, similarity_threshold = None, 
-               multiprocessing = True, nupack_params = {}):
+               multiprocessing = True, nupack_params = {}, executor = None,
+               pool_size = None):
 
     # Store options
     self._multiprocessing = multiprocessing
+    self._executor = executor
+    self._journal = None
+    self._journal_key = None
+
+    # Structures sampled from the Boltzmann distribution but not yet added
+    self._pool = collections.deque()
+    if pool_size is not None:
+      self.pool_size = pool_size
+
+    # Number of times each structure was added, and the widest list of suboptimal
+    # structures found by get_top_MFE_structs() with its energy gap.
+    self._struct_counts = collections.Counter()
+    self._subopt_structs = None
+    self._subopt_gap = None
 
     # Store nupack params
     self._nupack_params = dict(nupack_params)
@@ -82,6 +115,15 @@ class NupackSampleJob(object):
   def restingset(self):
     return self._restingset
 
+  @property
+  def executor(self):
+    if self._executor is None:
+      return executors.get_default_executor()
+    return self._executor
+  @executor.setter
+  def executor(self, val):
+    self._executor = val
+
   @property
   def complex_names(self):
     return sorted([c.name for c in self.restingset.complexes], key = lambda k: self._complex_tags[k])
@@ -149,62 +191,105 @@ class NupackSampleJob(object):
     ## Recalculate complex counts for new similarity threshold
     self.update_complex_counts()
 
-  def sample(self, num_samples, status_func = lambda x: None):
-    """ Calls sample_multiprocessing or sample_singleprocessing depending on the value of
-    self._multiprocessing """
+  def sample(self, num_samples, status_func = lambda x: None, stop_func = None,
+      max_samples = None):
+    """ Adds num_samples structures taken from the pool of pre-sampled structures,
+    refilling the pool when it runs empty. Returns the number of structures added.
+    If stop_func is given, it is called after every samples_per_update structures
+    and no further structures are added once it returns True. Structures left in
+    the pool are used by later calls. A refill draws pool_size structures, or at
+    least those still missing from this call, but no more than max_samples minus
+    the structures added so far if max_samples (e.g. the number of structures a
+    caller may still add in total) is given. """
+    sims_completed = 0
+    while sims_completed < num_samples:
+      if not self._pool:
+        refill = self.pool_size
+        if max_samples is not None:
+          refill = min(refill, max_samples - sims_completed)
+        self.fill_pool(max(refill, num_samples - sims_completed))
+      n = min(self.samples_per_update, len(self._pool), num_samples - sims_completed)
+      self._add_sampled_structs([self._pool.popleft() for _ in range(n)])
+      sims_completed += n
+      status_func(sims_completed)
+      if stop_func is not None and stop_func():
+        break
+    return sims_completed
 
+  @property
+  def pool_count(self):
+    """ The number of pre-sampled structures that have not been added yet. """
+    return len(self._pool)
+
+  def fill_pool(self, num_samples = None):
+    """ Adds num_samples (by default pool_size) structures sampled from the Boltzmann
+    distribution to the pool, using sample_multiprocessing or
+    sample_singleprocessing depending on the value of self._multiprocessing. """
+    if num_samples is None:
+      num_samples = self.pool_size
     if self._multiprocessing:
-      self.sample_multiprocessing(num_samples, status_func = status_func)
+      structs = self.sample_multiprocessing(num_samples)
     else:
-      self.sample_singleprocessing(num_samples, status_func = status_func)
-
-  def sample_multiprocessing(self, num_samples, 
-      status_func = lambda x: None):
-    """ Runs sample() in multiple processes. """
-
-    # Temporarily remove SIGINT event handler from current process
-    sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+      structs = self.sample_singleprocessing(num_samples)
+    self._pool.extend(structs)
 
-    # Create Pool instance and worker processes
-    k = min(multiprocessing.cpu_count(), num_samples)
-    p = multiprocessing.Pool(processes = k)
+  def _sample_args(self, num_samples):
+    strands = next(iter(self.restingset.complexes)).strands
+    return ([strand.sequence for strand in strands], self._nupack_params, num_samples)
 
-    # Restore original SIGINT event handler (if possible)
-    if sigint_handler is None: sigint_handler = signal.SIG_DFL
-    signal.signal(signal.SIGINT, sigint_handler)
+  def set_journal(self, journal, key):
+    """ Appends every batch of sampled structures from now on to journal (a
+    journal.Journal), under the given key. Use replay_samples() to add journaled
+    batches to a job. """
+    self._journal = journal
+    self._journal_key = key
 
-    # Setup args for each process
-    samples_per_worker = int(num_samples / k)
-    args = [(self, samples_per_worker+1)] * (num_samples % k)
-    args += [(self, samples_per_worker)] * (k - (num_samples % k))
+  def replay_samples(self, structs):
+    """ Adds a batch of sampled structures read back from a journal. """
+    self._add_sampled_structs(structs, journal = False)
 
-    it = p.imap_unordered(sample_global, args)
-    p.close()
+  def _add_sampled_structs(self, structs, journal = True):
+    if journal and self._journal is not None:
+      self._journal.append(self._journal_key, structs)
 
+    # Convert each Nupack sampled structure (a dot-paren string) into a
+    # DNAObjects Complex object and process.
+    strands = next(iter(self.restingset.complexes)).strands
+    self.add_sampled_complexes([Complex(strands = strands, structure = s) for s in structs])
+    self._struct_counts.update(structs)
+
+  def sample_multiprocessing(self, num_samples):
+    """ Samples num_samples secondary structures on the workers of self.executor,
+    with at most one NUPACK call per worker, each drawing at least
+    min_samples_per_call structures, and returns them as dot-paren strings. """
+    executor = self.executor
+    num_tasks = max(1, min(executor.num_workers, num_samples // max(1, self.min_samples_per_call)))
+    samples_per_task = int(math.ceil(float(num_samples) / num_tasks))
+
+    tasks = executors.TaskGroup(executor)
     try:
-      sims_completed = 0
-      for cplx in it:
-        self.add_sampled_complexes(cplx)
-        sims_completed += len(cplx)
-        status_func(sims_completed)
+      sims_submitted = 0
+      while sims_submitted < num_samples:
+        n = min(samples_per_task, num_samples - sims_submitted)
+        tasks.submit(sample_global, self._sample_args(n))
+        sims_submitted += n
+      structs = []
+      while tasks.pending > 0:
+        _, task_structs, _, _ = tasks.next_result()
+        structs.extend(task_structs)
     except KeyboardInterrupt:
       print "SIGINT: Ending NUPACK sampling prematurely..."
-      p.terminate()
-      p.join()
+      executor.terminate()
       raise KeyboardInterrupt
-    return
+    return structs
 
-  def sample_singleprocessing(self, num_samples, status_func = lambda x: None):
+  def sample_singleprocessing(self, num_samples):
     """ Queries Nupack for num_samples secondary structures, sampled from the Boltzmann distribution
-    of secondary structures for this resting set. The sampled secondary structures are automatically
-    processed to compute new estimates for each conformation probability.
+    of secondary structures for this resting set, and returns them as dot-paren strings.
     The nupack_params dict that was given to this job during initialization is passed along to the
     Nupack Python interface.
     """
-    results = sample_global((self, num_samples))
-    self.add_sampled_complexes(results)
-
-    status_func(len(results))
+    return sample_global(self._sample_args(num_samples))
 
   def add_sampled_complexes(self, sampled):
     """ Processes a list of sampled Complex objects, computing the similarity to each of the
@@ -305,7 +390,7 @@ class NupackSampleJob(object):
     if verbose:
       if verbose > 1:
         if self._multiprocessing:
-          print '#    [MULTIPROCESSING ON] (over %d cores)'%multiprocessing.cpu_count()
+          print '#    [MULTIPROCESSING ON] (over %d cores)'%self.executor.num_workers
         else:
           print '#    [MULTIPROCESSING OFF]'
 
@@ -333,12 +418,16 @@ class NupackSampleJob(object):
       # Query Nupack
       if verbose:
         status_func(0) 
-      self.sample(num_trials, status_func = status_func if verbose else lambda x: None)
+      sims_run = self.sample(num_trials, 
+          status_func = status_func if verbose else lambda x: None,
+          stop_func = lambda: (self.get_complex_prob_error(complex_name) 
+            <= rel_goal * self.get_complex_prob(complex_name)),
+          max_samples = max_sims - num_sims)
       if verbose:
-        status_func(num_trials, inline=(verbose <= 2))
+        status_func(sims_run, inline=(verbose <= 2))
 
       # Update estimates and goal
-      num_sims += num_trials
+      num_sims += sims_run
       prob = self.get_complex_prob(complex_name)
       error = self.get_complex_prob_error(complex_name)
       goal = rel_goal * prob
@@ -358,12 +447,70 @@ class NupackSampleJob(object):
 
   # NOTE: actually, these are sampled suboptimal structures
   def get_top_MFE_structs(self, num):
+    """ Returns the structures within the smallest energy gap above the MFE that
+    contains at least num structures, as (structure, energy) tuples sorted by
+    energy. Structures with the same energy as the num-th are all included.
+    If enough structures have been sampled often enough, the result is taken from
+    the sampled structures; otherwise NUPACK's subopt is called with a geometrically
+    growing energy gap. The widest subopt result is kept, so later requests for as
+    many or fewer structures need no further NUPACK calls.
+
+    Unlike in earlier versions, energies are floats (kcal/mol) rather than the
+    strings printed by NUPACK, and structures beyond the smallest sufficient gap
+    are not returned. """
+    if num <= 0:
+      return []
+    structs = self._top_structs_from_samples(num)
+    if structs is None:
+      structs = self._top_structs_from_subopt(num)
+    return structs
+
+  @staticmethod
+  def _within_top(structs, num):
+    # Bisects a list of (structure, energy) sorted by energy for the smallest gap
+    # containing num structures
+    energies = [e for _, e in structs]
+    return structs[:bisect.bisect_right(energies, energies[num - 1])]
+
+  def _top_structs_from_subopt(self, num):
+    if self._subopt_structs is None or len(self._subopt_structs) < num:
+      strands = next(iter(self.restingset.complexes)).strands
+      strand_seqs = [strand.sequence for strand in strands]
+      energy_gap = 0.1 if self._subopt_gap is None else 2 * self._subopt_gap
+      while True:
+        struct_list = nupack.subopt(strand_seqs, energy_gap, **self._nupack_params)
+        if len(struct_list) >= num:
+          break
+        energy_gap *= 2
+      self._subopt_gap = energy_gap
+      self._subopt_structs = sorted(((s, float(e)) for s, e in struct_list), key = lambda (s, e): e)
+    return self._within_top(self._subopt_structs, num)
+
+  def _top_structs_from_samples(self, num):
+    """ Returns the result of get_top_MFE_structs() computed from the sampled
+    structures, or None if they may not include all of its structures.
+    A structure at least twice as probable as one expected to be sampled
+    min_sample_count times is almost certainly sampled min_sample_count times or
+    more (for the default of 20, it fails with probability below 0.1%). All
+    structures below the corresponding energy are therefore among the frequently
+    sampled ones, whose energies are computed. Returns None as well if there are
+    more than max_energy_calls of them, for which subopt is faster. """
+    num_sampled = sum(self._struct_counts.itervalues())
+    frequent = [s for s, c in self._struct_counts.iteritems() if c >= self.min_sample_count]
+    if len(frequent) < num or len(frequent) > self.max_energy_calls:
+      return None
+
     strands = next(iter(self.restingset.complexes)).strands
     strand_seqs = [strand.sequence for strand in strands]
-    energy_gap = 0.1
-    struct_list = []
-    while len(struct_list) < num:
-      struct_list = nupack.subopt(strand_seqs, energy_gap, **self._nupack_params)
-      energy_gap += 0.5
-    return struct_list
-
+    T = self._nupack_params.get('T', 37)
+    kT = 0.0019872041 * (T + 273.15) # kcal/mol
+    # Ensemble free energy, in the units of nupack.energy()
+    dG = nupack.pfunc(strand_seqs, **self._nupack_params) - nupack.dGadjust(T, len(strand_seqs))
+    max_energy = dG - kT * math.log(2.0 * self.min_sample_count / num_sampled)
+
+    structs = sorted(((s, nupack.energy(strand_seqs, s, **self._nupack_params)) for s in frequent),
+        key = lambda (s, e): e)
+    structs = [(s, e) for s, e in structs if e <= max_energy]
+    if len(structs) < num:
+      return None
+    return self._within_top(structs, num)
@@ -0,0 +1,122 @@
+# resultcache.py
+#
+# Defines ResultCache, a content-addressed on-disk cache of Multistrand results.
+# Results are filed under a hash of everything that determines the outcome of a
+# simulation (sequences, structures, stop conditions, Boltzmann selectors and
+# Multistrand parameters), so that any job with the same definition can reuse
+# them, whether in a rebuilt System or in a different system sharing a reporter.
+# Sequences are the concrete sequences simulated, which for degenerate domains are
+# drawn anew for each conversion to Multistrand, and the Multistrand version is
+# part of the key.
+
+import os
+import uuid
+import hashlib
+import cPickle as pickle
+
+from ..objects import RestingSet, Macrostate
+
+
+def multistrand_version():
+  try:
+    import multistrand
+  except ImportError:
+    return None
+  return getattr(multistrand, '__version__', None)
+
+def _complex_description(cpx, sequences):
+  return ('complex',
+      tuple(sequences[s] for s in cpx.strands),
+      cpx.structure.to_dotparen())
+
+def _state_description(obj, sequences):
+  if isinstance(obj, RestingSet):
+    return ('restingset', tuple(sorted(_complex_description(c, sequences) for c in obj.complexes)))
+  else:
+    return _complex_description(obj, sequences)
+
+def _macrostate_description(macrostate, sequences):
+  # Names of nested macrostates are generated automatically, so only the
+  # structure of the macrostate is described.
+  t = macrostate.type
+  if t == Macrostate.types['conjunction'] or t == Macrostate.types['disjunction']:
+    return (t, tuple(sorted(_macrostate_description(m, sequences) for m in macrostate.macrostates)))
+  elif t == Macrostate.types['count'] or t == Macrostate.types['loose']:
+    return (t, _complex_description(macrostate.complex, sequences), repr(macrostate.cutoff))
+  else:
+    return (t, _complex_description(macrostate.complex, sequences))
+
+def _selector_description(selector):
+  if selector is None:
+    return None
+  return (type(selector).__name__, repr(getattr(selector, '_threshold', None)))
+
+def job_key(start_state, stop_conditions, sim_mode, boltzmann_selectors, multistrand_params,
+    strand_sequences):
+  """ Returns the cache key of a Multistrand job, a hex digest of a canonical
+  description of its definition. strand_sequences maps each strand to the concrete
+  sequence given to Multistrand. The order of the start state is irrelevant, and
+  only the names of the top-level stop conditions (which become the result tags)
+  are included. """
+  if boltzmann_selectors is None:
+    boltzmann_selectors = [None] * len(start_state)
+  sequences = dict(strand_sequences)
+  description = (
+      'multistrand', multistrand_version(), sim_mode,
+      tuple(sorted((_state_description(s, sequences), _selector_description(b))
+          for s, b in zip(start_state, boltzmann_selectors))),
+      tuple(sorted((m.name, _macrostate_description(m, sequences)) for m in stop_conditions)),
+      tuple(sorted((k, repr(v)) for k, v in multistrand_params.iteritems()
+          if k != 'verbosity'))
+  )
+  return hashlib.sha1(repr(description)).hexdigest()
+
+
+class ResultCache(object):
+  """ A directory of cached Multistrand results.
+
+  Each job key has a subdirectory holding any number of entries, each written
+  once with an atomic rename and never modified, so that several KinDA processes
+  may share a cache directory. An entry holds the results of a run of simulations
+  with their tags stored by name (see MultistrandJob.flush_result_cache()).
+  """
+  def __init__(self, directory):
+    self._directory = os.path.abspath(directory)
+
+  @property
+  def directory(self):
+    return self._directory
+
+  def load(self, key):
+    """ Returns the list of entries stored under key. """
+    path = os.path.join(self._directory, key)
+    if not os.path.isdir(path):
+      return []
+    entries = []
+    for filename in sorted(os.listdir(path)):
+      if not filename.endswith('.pkl'):
+        continue
+      with open(os.path.join(path, filename), 'rb') as f:
+        entries.append(pickle.load(f))
+    return entries
+
+  def store(self, key, tag_names, results, invalid):
+    """ Adds an entry under key. results maps each result field to a numpy array,
+    with integer tags translated to names by tag_names; invalid is the list of
+    invalid simulation records, indexed relative to results. """
+    path = os.path.join(self._directory, key)
+    if not os.path.isdir(path):
+      try:
+        os.makedirs(path)
+      except OSError:
+        if not os.path.isdir(path):
+          raise
+    entry = {
+      'tag_names': dict(tag_names),
+      'results': dict(results),
+      'invalid': invalid
+    }
+    filename = os.path.join(path, uuid.uuid4().hex)
+    with open(filename + '.tmp', 'wb') as f:
+      pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename + '.pkl')
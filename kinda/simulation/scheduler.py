@@ -0,0 +1,197 @@
+# scheduler.py
+#
+# Defines SimulationScheduler, which reduces the error on many statistics of
+# many Multistrand jobs at once, interleaving the simulation tasks of all jobs
+# on one shared executor so that no worker sits idle at batch or job boundaries.
+
+import executors
+import sim_utils
+
+class SimulationGoal(object):
+  """ An error goal for one or more statistics of a MultistrandJob: simulations are
+  requested until the standard error of each statistic is below rel_goal*mean or
+  max_sims simulations have been submitted on behalf of this goal. If sims_per_worker
+  is given, each task of this goal runs that many simulations (fewer at the end)
+  instead of a number chosen by the job's ChunkSizeController. """
+  def __init__(self, job, reaction, stats, rel_goal, max_sims, sims_per_worker = None):
+    if isinstance(stats, basestring):
+      stats = [stats]
+    self.job = job
+    self.reaction = reaction
+    self.stats = list(stats)
+    self.rel_goal = rel_goal
+    self.max_sims = max_sims
+    self.sims_per_worker = sims_per_worker
+
+    self.sims_submitted = 0 # simulations submitted on behalf of this goal
+    self.sims_in_flight = 0
+
+  def _stat_is_met(self, stat):
+    mean = self.job.get_statistic(self.reaction, stat)
+    error = self.job.get_statistic_error(self.reaction, stat)
+    return error < self.rel_goal * mean
+
+  def is_met(self):
+    return all(self._stat_is_met(stat) for stat in self.stats)
+
+  def _stat_sims_wanted(self, stat, init_batch_size, min_batch_size, max_batch_size):
+    total_sims = self.job.total_sims
+    error = self.job.get_statistic_error(self.reaction, stat)
+    goal = self.rel_goal * self.job.get_statistic(self.reaction, stat)
+    if error < goal:
+      return 0
+    elif total_sims == 0:
+      return init_batch_size
+    elif error == float('inf') or goal == 0.0:
+      return max_batch_size
+    else:
+      exp_add_sims = int(total_sims * ((error / goal)**2 - 1) + 1)
+      return max(min(max_batch_size, exp_add_sims, total_sims + 1), min_batch_size)
+
+  def sims_wanted(self, init_batch_size, min_batch_size, max_batch_size):
+    """ Returns the number of simulations this goal would like to add to those
+    already in flight, estimated as in MultistrandJob.reduce_error_to(). """
+    num_trials = max(self._stat_sims_wanted(stat, init_batch_size, min_batch_size, max_batch_size)
+        for stat in self.stats)
+    num_trials = min(num_trials, self.max_sims - self.sims_submitted + self.sims_in_flight)
+    return max(0, num_trials - self.sims_in_flight)
+
+
+class SimulationScheduler(object):
+  """ Runs the simulations needed to satisfy a list of SimulationGoals.
+
+  Tasks from all jobs are submitted to a single executor. Whenever a worker becomes
+  free, the next task is given to the unmet goal whose job has the fewest simulations
+  in flight, so all goals progress concurrently. Error estimates are updated as each
+  task finishes, and no new tasks are submitted for goals that are met or out of
+  budget; tasks already in flight are allowed to finish and their results are kept.
+
+  Usage:
+    scheduler = SimulationScheduler()
+    scheduler.add_goal(job, 'reaction_tag', ['k1', 'k2'], 0.1, 10000)
+    scheduler.run()
+  """
+  def __init__(self, executor = None,
+      init_batch_size = 50,
+      min_batch_size = 50,
+      max_batch_size = 500,
+      progress_func = None,
+      goal_done_func = None,
+      verbose = 0):
+    """ executor defaults to the executor of the first goal's job.
+    progress_func, if given, is called as progress_func(goal) whenever a task
+    finishes, after its results were added to goal.job, and replaces the default
+    progress table printed when verbose is nonzero. goal_done_func, if given, is
+    called as goal_done_func(goal) once for each goal that received results, as
+    soon as it is met or out of budget and none of its tasks are in flight (e.g.
+    to back up the results of long runs). """
+    self._executor = executor
+    self._init_batch_size = init_batch_size
+    self._min_batch_size = min_batch_size
+    self._max_batch_size = max_batch_size
+    self._progress_func = progress_func
+    self._goal_done_func = goal_done_func
+    self._verbose = verbose
+
+    self._goals = []
+
+  @property
+  def goals(self):
+    return self._goals[:]
+
+  def add_goal(self, job, reaction, stats, rel_goal, max_sims, sims_per_worker = None):
+    """ Adds a goal for the given statistic (or list of statistics) of a reaction
+    tag of job, and returns the new SimulationGoal. """
+    goal = SimulationGoal(job, reaction, stats, rel_goal, max_sims, sims_per_worker)
+    self._goals.append(goal)
+    return goal
+
+  def _sims_wanted(self, goal):
+    return goal.sims_wanted(self._init_batch_size, self._min_batch_size, self._max_batch_size)
+
+  def run(self):
+    """ Runs simulations until every goal is met or has used up its max_sims. """
+    if not self._goals:
+      return
+    executor = self._executor if self._executor is not None else self._goals[0].job.executor
+    tasks = executors.TaskGroup(executor)
+
+    jobs = []
+    for goal in self._goals:
+      if goal.job not in jobs:
+        jobs.append(goal.job)
+    for job in jobs:
+      job.load_cached_results()
+      job.calibrate_simulation_time(verbose = self._verbose)
+      executor.publish(job.spec.spec_id, job.spec)
+    job_in_flight = {job: 0 for job in jobs}
+    controllers = {job: job.get_chunk_controller(executor.num_workers) for job in jobs}
+    last_submit = {goal: i for i, goal in enumerate(self._goals)}
+    goals_done = set()
+    num_submits = len(self._goals)
+
+    if self._verbose and self._progress_func is None:
+      update_func = sim_utils.print_progress_table(
+          ["goals met", "active", "sims done", "in flight"],
+          col_widths = [12, 10, 12, 12])
+
+    try:
+      while True:
+        # Fill every free worker with a task for the neediest goal
+        while tasks.pending < executor.num_workers:
+          wanted = [(g, self._sims_wanted(g)) for g in self._goals]
+          wanted = [(g, n) for g, n in wanted if n > 0]
+          if not wanted:
+            break
+          goal, n = min(wanted, key = lambda (g, n): (job_in_flight[g.job], last_submit[g]))
+          job = goal.job
+          if goal.sims_per_worker is not None:
+            n = min(goal.sims_per_worker, n)
+          else:
+            n = controllers[job].next_chunk(n)
+
+          goal.sims_in_flight += n
+          goal.sims_submitted += n
+          job_in_flight[job] += n
+          job.preallocate_batch(job_in_flight[job])
+          func, arg = job.create_task(n)
+          tasks.submit(func, arg, tag = (goal, n))
+          last_submit[goal] = num_submits
+          num_submits += 1
+
+        if tasks.pending == 0:
+          break
+
+        (goal, n), block, compute_time, round_trip_time = tasks.next_result()
+        job = goal.job
+        job.process_results(block)
+        controllers[job].update(n, compute_time, round_trip_time)
+        goal.sims_in_flight -= n
+        job_in_flight[job] -= n
+
+        if (self._goal_done_func is not None and goal.sims_in_flight == 0
+            and goal not in goals_done
+            and (goal.sims_submitted >= goal.max_sims or goal.is_met())):
+          goals_done.add(goal)
+          self._goal_done_func(goal)
+
+        if self._progress_func is not None:
+          self._progress_func(goal)
+        elif self._verbose:
+          num_met = sum(1 for g in self._goals if g.is_met())
+          num_active = sum(1 for g in self._goals if g.sims_in_flight > 0)
+          update_func(["{}/{}".format(num_met, len(self._goals)), num_active,
+            sum(j.total_sims for j in jobs), sum(job_in_flight.values())], inline = self._verbose <= 3)
+    except KeyboardInterrupt:
+      print "SIGINT: Terminating Multistrand processes prematurely..."
+      executor.terminate()
+      for job in jobs:
+        job.flush_result_cache()
+      raise KeyboardInterrupt
+
+    for job in jobs:
+      job.flush_result_cache()
+      executor.unpublish(job.spec.spec_id)
+
+    if self._verbose and self._progress_func is None:
+      print
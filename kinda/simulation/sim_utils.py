@@ -7,6 +7,10 @@ from __future__ import print_function
 
 import sys
 import math
+import json
+import zlib
+import base64
+import random
 import numpy as np
 
 from multistrand.options import Options as MSOptions
@@ -54,6 +58,291 @@ def print_progress_table(col_headers, col_widths = None, col_init_data = None,
   return update_progress
 
 
+class ChunkSizeController(object):
+  """ Chooses how many simulations to send to a worker in a single task.
+
+  The controller keeps running estimates of the wall-clock time per simulation
+  and of the fixed overhead per task (IPC, scheduling), updated from each finished
+  task with update(). next_chunk() then sizes tasks so that each one runs for about
+  target_duration seconds, and long enough that the overhead is at most
+  max_overhead of the task's run time. Towards the end of a batch, tasks are shrunk
+  so that the remaining simulations are spread over all workers, to avoid waiting
+  on a few large straggling tasks.
+
+  Args:
+    num_workers (int): Number of workers executing tasks concurrently.
+    target_duration (float, optional): Desired run time of each task [seconds].
+    max_overhead (float, optional): Maximum fraction of a task's run time that may be
+      spent on overhead.
+    min_chunk, max_chunk (int, optional): Bounds on the number of simulations per task.
+    smoothing (float, optional): Weight of the newest measurement in the running averages.
+  """
+  def __init__(self, num_workers, target_duration = 1.0, max_overhead = 0.05,
+      min_chunk = 1, max_chunk = 10000, smoothing = 0.2):
+    self.num_workers = num_workers
+    self.target_duration = target_duration
+    self.max_overhead = max_overhead
+    self.min_chunk = min_chunk
+    self.max_chunk = max_chunk
+    self.smoothing = smoothing
+
+    self.time_per_sim = None
+    self.overhead = 0.0
+
+  def update(self, num_sims, compute_time, round_trip_time):
+    """ Records the timing of a finished task of num_sims simulations. """
+    if num_sims <= 0:
+      return
+    a = self.smoothing
+    t = compute_time / num_sims
+    o = max(0.0, round_trip_time - compute_time)
+    if self.time_per_sim is None:
+      self.time_per_sim, self.overhead = t, o
+    else:
+      self.time_per_sim = (1-a) * self.time_per_sim + a * t
+      self.overhead = (1-a) * self.overhead + a * o
+
+  def next_chunk(self, remaining):
+    """ Returns the number of simulations for the next task, given the number of
+    simulations remaining in the batch that have not been submitted yet. """
+    if self.time_per_sim is None:
+      # No timing data yet: probe with the smallest tasks
+      chunk = self.min_chunk
+    else:
+      duration = max(self.target_duration, self.overhead / self.max_overhead)
+      chunk = int(duration / max(self.time_per_sim, 1e-9))
+
+    # Guided self-scheduling: never take more than a fair share of what is left
+    fair_share = int(math.ceil(remaining / (2.0 * self.num_workers)))
+    chunk = min(chunk, self.max_chunk, fair_share)
+    return max(self.min_chunk, min(chunk, remaining))
+
+
+class ResultStore(object):
+  """ Growable column store for per-simulation results.
+
+  Each column is a numpy array of a fixed dtype, of which the first len(store)
+  entries hold data. Capacity grows geometrically, so that adding n results costs
+  O(n) amortized time and memory stays within a constant factor of the data size.
+  view() and views() return slices of the underlying arrays without copying; they
+  remain valid until the store has to grow.
+
+  Args:
+    dtypes (dict): Maps each column name to its numpy dtype.
+    growth_factor (float, optional): Factor by which the capacity is increased
+      when more space is needed.
+  """
+  def __init__(self, dtypes, growth_factor = 1.5, min_capacity = 64):
+    self._growth_factor = growth_factor
+    self._min_capacity = min_capacity
+    self._columns = {k: np.empty(0, dtype = dt) for k, dt in dtypes.iteritems()}
+    self._size = 0
+
+  def __len__(self):
+    return self._size
+
+  @property
+  def capacity(self):
+    return len(next(self._columns.itervalues())) if self._columns else 0
+
+  @property
+  def columns(self):
+    return self._columns.keys()
+
+  def add_column(self, key, dtype):
+    """ Adds a column, filled with zeros for the results already stored. """
+    self._columns[key] = np.zeros(self.capacity, dtype = dtype)
+
+  def reserve(self, capacity):
+    """ Ensures that the store can hold capacity results without reallocating. """
+    if capacity <= self.capacity:
+      return
+    capacity = max(capacity, int(self.capacity * self._growth_factor), self._min_capacity)
+    for k, col in self._columns.items():
+      new_col = np.empty(capacity, dtype = col.dtype)
+      new_col[:self._size] = col[:self._size]
+      self._columns[k] = new_col
+
+  def append(self, data):
+    """ Appends the results in data, a dict mapping every column name to a sequence
+    of values; entries for other keys are ignored. Values are cast to the dtypes of
+    the columns. """
+    if not self._columns:
+      return
+    n = len(data[next(iter(self._columns))])
+    self.reserve(self._size + n)
+    for k, col in self._columns.iteritems():
+      col[self._size:self._size + n] = data[k]
+    self._size += n
+
+  def set_data(self, data):
+    """ Replaces all stored results with those in data (see append()). """
+    self._size = 0
+    self.append(data)
+
+  def view(self, key):
+    return self._columns[key][:self._size]
+
+  def views(self):
+    """ Returns a dict of views of all columns. """
+    return {k: col[:self._size] for k, col in self._columns.iteritems()}
+
+
+class InvalidRecordStore(object):
+  """ Compact store for the records describing invalid (timed-out or failed)
+  simulations, as produced by multistrandjob.reduce_ms_results().
+
+  Records are kept as columns: simulation index, end time and seed, plus ids of
+  interned strings for the record type and the start structure, so that a
+  structure shared by many records is stored only once. End states, the largest
+  part of a record, are kept as compressed JSON and decoded only on request.
+
+  If max_records is given, at most that many records are retained. With policy
+  'first', records beyond the limit are dropped; with policy 'reservoir', the
+  retained records are a uniform random sample of all records added (reservoir
+  sampling). num_seen counts all records added, retained or not.
+
+  Args:
+    max_records (int, optional): Maximum number of records retained.
+    policy (str, optional): 'reservoir' or 'first'.
+    seed (optional): Seed of the random number generator used for sampling.
+  """
+  _NO_SEED = -2**63 # stored for records without a seed
+
+  def __init__(self, max_records = None, policy = 'reservoir', seed = None):
+    assert policy in ('reservoir', 'first'), "Unknown retention policy {}".format(policy)
+    self._max_records = max_records
+    self._policy = policy
+    self._rng = random.Random(seed)
+    self._columns = ResultStore({
+        'simulation_index': np.int64,
+        'end_time': np.float64,
+        'seed': np.int64,
+        'type': np.int32,
+        'start_structure': np.int32
+        }, min_capacity = 8)
+    self._end_states = [] # compressed JSON, or None
+    self._strings = []
+    self._string_ids = {}
+    self._num_seen = 0
+
+  def __len__(self):
+    return len(self._columns)
+
+  @property
+  def num_seen(self):
+    return self._num_seen
+
+  def _intern(self, string):
+    if string is None:
+      return -1
+    string = str(string)
+    if string not in self._string_ids:
+      self._string_ids[string] = len(self._strings)
+      self._strings.append(string)
+    return self._string_ids[string]
+
+  def _string(self, string_id):
+    return self._strings[string_id] if string_id >= 0 else None
+
+  def _slot(self):
+    # Returns the index at which the next record is stored, or None to drop it
+    self._num_seen += 1
+    if self._max_records is None or len(self) < self._max_records:
+      return len(self)
+    elif self._policy == 'reservoir':
+      i = self._rng.randint(0, self._num_seen - 1)
+      return i if i < self._max_records else None
+    else:
+      return None
+
+  def add(self, record, offset = 0):
+    """ Adds a record, a dict with the keys 'simulation_index', 'end_time', 'type',
+    'seed', 'start_structure' and 'end_state' (missing keys are allowed).
+    offset is added to the simulation index. """
+    slot = self._slot()
+    if slot is None:
+      return
+    end_state = record.get('end_state')
+    if end_state is not None:
+      end_state = zlib.compress(json.dumps(end_state, separators = (',', ':')))
+    seed = record.get('seed')
+    values = {
+        'simulation_index': record['simulation_index'] + offset,
+        'end_time': record.get('end_time', float('nan')),
+        'seed': seed if seed is not None else self._NO_SEED,
+        'type': self._intern(record.get('type')),
+        'start_structure': self._intern(record.get('start_structure'))
+    }
+    if slot == len(self):
+      self._columns.append({k: [v] for k, v in values.iteritems()})
+      self._end_states.append(end_state)
+    else:
+      for k, v in values.iteritems():
+        self._columns.view(k)[slot] = v
+      self._end_states[slot] = end_state
+
+  def extend(self, records, offset = 0):
+    """ Adds a list of records (see add()) or the records of another InvalidRecordStore.
+    offset is added to all simulation indices. """
+    if isinstance(records, InvalidRecordStore):
+      records = records.records()
+    for record in records:
+      self.add(record, offset)
+
+  def end_state(self, i):
+    """ Returns the decoded end state of the i-th record. """
+    end_state = self._end_states[i]
+    return json.loads(zlib.decompress(end_state)) if end_state is not None else None
+
+  def record(self, i, end_state = True):
+    """ Returns the i-th record as a dict. The end state is only decoded if end_state is True. """
+    seed = int(self._columns.view('seed')[i])
+    record = {
+        'simulation_index': int(self._columns.view('simulation_index')[i]),
+        'end_time': float(self._columns.view('end_time')[i]),
+        'type': self._string(self._columns.view('type')[i]),
+        'seed': seed if seed != self._NO_SEED else None,
+        'start_structure': self._string(self._columns.view('start_structure')[i])
+    }
+    if end_state:
+      record['end_state'] = self.end_state(i)
+    return record
+
+  def records(self, end_state = True):
+    """ Returns all retained records as a list of dicts. """
+    return [self.record(i, end_state) for i in range(len(self))]
+
+  def clear(self):
+    self._columns.set_data({k: [] for k in self._columns.columns})
+    self._end_states = []
+    self._strings = []
+    self._string_ids = {}
+    self._num_seen = 0
+
+  def to_dict(self):
+    """ Returns the records in a JSON-compatible columnar form, accepted by set_data(). """
+    return {
+      'num_seen': self._num_seen,
+      'strings': list(self._strings),
+      'columns': {k: v.tolist() for k, v in self._columns.views().iteritems()},
+      'end_states': [base64.b64encode(e) if e is not None else None for e in self._end_states]
+    }
+
+  def set_data(self, data):
+    """ Replaces all records with those in data, either a dict returned by to_dict()
+    or a list of records (see add()). """
+    self.clear()
+    if isinstance(data, dict):
+      self._strings = [str(string) for string in data['strings']]
+      self._string_ids = {string: i for i, string in enumerate(self._strings)}
+      self._columns.set_data(data['columns'])
+      self._end_states = [base64.b64decode(e) if e is not None else None for e in data['end_states']]
+      self._num_seen = data['num_seen']
+    else:
+      self.extend(data)
+
+
 ################################
 # CUSTOM STATISTICAL FUNCTIONS
 ################################ 
@@ -41,14 +41,18 @@ class RestingSetRxnStats(object):
     reactants = kargs['reactants']
     products = kargs['products']
     multijob = kargs.get('multistrand_job', None)
+    multijob_factory = kargs.get('multistrand_job_factory', None)
     multijob_tag = kargs.get('tag', 'success')
   
     ## Store reactants and products
     self.reactants = reactants[:]
     self.products = products[:]
       
-    ## Make Multistrand job object for k1 and k2
-    if multijob == None:
+    ## Make Multistrand job object for k1 and k2. A job given by a factory
+    ## (see stats_utils.MultistrandJobFactory) is created on first use.
+    self._multijob = None
+    self._multijob_factory = multijob_factory
+    if multijob == None and multijob_factory == None:
       if len(self.reactants) == 2:
         self.multijob = FirstStepModeJob(self.reactants, [self.products], [multijob_tag])
       elif len(self.reactants) == 1:
@@ -62,6 +66,27 @@ class RestingSetRxnStats(object):
     
     ## Initialize RestingSetStats list
     self.rs_stats = {rs: None for rs in self.reactants}
+
+  @property
+  def multijob(self):
+    if self._multijob is None and self._multijob_factory is not None:
+      self._multijob = self._multijob_factory()
+    return self._multijob
+  @multijob.setter
+  def multijob(self, job):
+    self._multijob = job
+
+  def has_multistrandjob(self):
+    """ Returns False if the Multistrand job has not been created yet. """
+    return self._multijob is not None or \
+        (self._multijob_factory is not None and self._multijob_factory.created)
+
+  def on_multistrandjob(self, func):
+    """ Calls func(job) with the Multistrand job as soon as it has been created. """
+    if self._multijob is None and self._multijob_factory is not None:
+      self._multijob_factory.add_callback(func)
+    elif self._multijob is not None:
+      func(self._multijob)
     
   
   def _get_reduced_k1_stats(self, relative_error, max_sims):
@@ -160,7 +185,8 @@ class RestingSetRxnStats(object):
       min_batch_size = 50, 
       max_batch_size = 500, 
       sims_per_update = 1, 
-      sims_per_worker = 1):
+      sims_per_worker = None,
+      streaming = True):
     """ General function to reduce the error on the given statistic
     to below the given threshold and return the value and standard
     error of the statistic. """
@@ -173,6 +199,7 @@ class RestingSetRxnStats(object):
         max_batch_size = max_batch_size,
         sims_per_update = sims_per_update,
         sims_per_worker = sims_per_worker,
+        streaming = streaming,
         verbose = verbose)
 
     # Calculate and return statistic
@@ -276,9 +303,8 @@ class RestingSetStats(object):
     
     
   def get_top_MFE_structs(self, num):
-    """ Attempts to obtain the top <num> MFE structures by calling
-    NUPACK's subopt executable with increasingly higher energy gaps
-    until enough structures are returned. """
+    """ Returns at least the top <num> MFE structures, as (structure, energy)
+    tuples with energies as floats (see NupackSampleJob.get_top_MFE_structs()). """
     return self.get_nupackjob().get_top_MFE_structs(num)
     
   def get_temporary_depletion_due_to(self, rxn, relative_error = 0.5, max_sims=500):
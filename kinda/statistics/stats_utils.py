@@ -11,6 +11,7 @@
 
 import sys
 import json
+import uuid
 import pickle
 import numpy as np
 import itertools as it
@@ -19,6 +20,10 @@ from .. import __version__ as KINDA_VERSION
 from .. import objects as dna
 from .. import options
 from ..simulation.multistrandjob import FirstPassageTimeModeJob, FirstStepModeJob
+from ..simulation.ffsjob import ForwardFluxJob, count_interfaces
+from ..simulation.scheduler import SimulationScheduler
+from ..simulation.resultcache import ResultCache
+from ..simulation import executors
 from .stats import RestingSetRxnStats, RestingSetStats
 
 class SystemStatsImportError(Exception):
@@ -71,14 +76,32 @@ def make_RestingSetRxnStats(restingsets, detailed_rxns, condensed_rxns,
         ]
     )
   
-  # Make a Multistrand simulation job for each reactant group
+  # Prepare a Multistrand simulation job for each reactant group. Jobs are only
+  # created when the statistics of one of their reactions are first requested.
+  # All jobs share one conversion context, so each object is converted to
+  # Multistrand only once.
+  multistrand_context = dna.io_Multistrand.MultistrandContext()
   reactants_to_mjob = {}
-  for i, reactants in enumerate(all_reactants):
-    # Group all products coming from these reactants together
-    enum_prods = [list(rxn.products) for rxn in condensed_rxns if rxn.reactants_equal(reactants)]
 
-    # Get spurious products from these reactants
-    spurious_prods = get_spurious_products(reactants, detailed_rxns, enum_prods)
+  # Group all products coming from each set of reactants together
+  all_reactants = sorted(all_reactants, key = lambda reactants: [rs.id for rs in reactants])
+  reactants_to_prods = {
+      reactants: [list(rxn.products) for rxn in condensed_rxns if rxn.reactants_equal(reactants)]
+      for reactants in all_reactants}
+
+  # Get spurious products from these reactants, using worker processes if multiprocessing
+  # is on and they are running already. Constructing a System does not start a worker
+  # pool or wait for TCP workers, since no simulation may follow.
+  if kinda_params.get('multistrand_multiprocessing', True):
+    executor = executors.get_running_executor()
+  else:
+    executor = None
+  reactants_to_spurious = get_spurious_products_all(all_reactants, detailed_rxns,
+      reactants_to_prods, executor = executor)
+
+  for i, reactants in enumerate(all_reactants):
+    enum_prods = reactants_to_prods[reactants]
+    spurious_prods = reactants_to_spurious[reactants]
     new_spurious_rxns = [
         dna.RestingSetReaction(
             reactants = reactants,
@@ -90,46 +113,12 @@ def make_RestingSetRxnStats(restingsets, detailed_rxns, condensed_rxns,
     tags = [str(rxn) for rxn in condensed_rxns if rxn.reactants_equal(reactants)]
     tags += ['_spurious({})'.format(str(rxn)) for rxn in new_spurious_rxns]
     spurious_flags = [False]*len(enum_prods) + [True]*len(spurious_prods)
-    
-    # Make Macrostates for Multistrand stop conditions
-    stop_conditions = [
-      create_stop_macrostate(state, tag, spurious = spurious_flag, options = kinda_params)
-        for state, tag, spurious_flag
-        in zip(enum_prods + spurious_prods, tags, spurious_flags)
-      ]
-    
-    # Make Boltzmann sampling selector functions for each reactant
-    start_macrostate_mode = kinda_params.get('start_macrostate_mode', 'ordered-complex')
-    similarity_threshold = kinda_params['multistrand_similarity_threshold']
-    boltzmann_selectors = [
-        create_boltzmann_selector(
-            restingset, 
-            mode = start_macrostate_mode,
-            similarity_threshold = similarity_threshold
-        )
-        for restingset in reactants
-    ]
 
-    # Make Multistrand job
-    multiprocessing = kinda_params.get('multistrand_multiprocessing', True)
-    if len(reactants) == 2:
-      job = FirstStepModeJob(
-          reactants,
-          stop_conditions,
-          boltzmann_selectors = boltzmann_selectors,
-          multiprocessing = multiprocessing,
-          multistrand_params = multistrand_params
-      )
-    elif len(reactants) == 1:
-      job = FirstPassageTimeModeJob(
-          reactants,
-          stop_conditions,
-          unimolecular_k1_scale = kinda_params['unimolecular_k1_scale'],
-          boltzmann_selectors = boltzmann_selectors,
-          multiprocessing = multiprocessing,
-          multistrand_params = multistrand_params
-      )
-    reactants_to_mjob[reactants] = job
+    reactants_to_mjob[reactants] = MultistrandJobFactory(reactants,
+        enum_prods + spurious_prods, tags, spurious_flags,
+        kinda_params = kinda_params,
+        multistrand_params = multistrand_params,
+        multistrand_context = multistrand_context)
 
     #print "KinDA: Constructing internal KinDA objects... {}%\r".format(100*i/len(all_reactants)),
     #sys.stdout.flush()
@@ -140,7 +129,7 @@ def make_RestingSetRxnStats(restingsets, detailed_rxns, condensed_rxns,
     stats = RestingSetRxnStats(
         reactants = rxn.reactants,
         products = rxn.products,
-        multistrand_job = reactants_to_mjob[tuple(sorted(rxn.reactants, key = lambda rs: rs.id))],
+        multistrand_job_factory = reactants_to_mjob[tuple(sorted(rxn.reactants, key = lambda rs: rs.id))],
         tag = str(rxn)
     )
     rxn_to_stats[rxn] = stats
@@ -154,7 +143,7 @@ def make_RestingSetRxnStats(restingsets, detailed_rxns, condensed_rxns,
     stats = RestingSetRxnStats(
         reactants = rxn.reactants,
         products = rxn.products,
-        multistrand_job = reactants_to_mjob[tuple(sorted(rxn.reactants, key = lambda rs: rs.id))],
+        multistrand_job_factory = reactants_to_mjob[tuple(sorted(rxn.reactants, key = lambda rs: rs.id))],
         tag = '_spurious({0})'.format(str(rxn))
     )
     rxn_to_stats[rxn] = stats
@@ -163,107 +152,211 @@ def make_RestingSetRxnStats(restingsets, detailed_rxns, condensed_rxns,
 
   return rxn_to_stats
   
-def get_spurious_products(reactants, reactions, stop_states):
-  """ It is desirable to have Multistrand simulations end
-  when interacting complexes have deviated so much from expected
-  trajectories that any calculated reaction times actually
-  include undesired interactions.
-  Complexes along expected reaction trajectories are split up
-  in all possible ways, and expected complexes are disregarded.
-  This produces all unexpected complexes produced 'one step' away
-  from the expected reaction trajectories. Note that complexes 
-  produced by binding of the two reactants in unexpected ways
-  are classified as unproductvie unless they dissociate into an
-  unenumerated strand-level complex, in which case they are
-  considered to be spurious.  """
-  def hashable_strand_rotation(strands):
-    index = 0
-    poss_starts = range(len(strands))
-    strands_ext = strands + strands
-    while len(poss_starts) > 1 and index < len(strands):
-      to_compare = [strands_ext[i + index] for i in poss_starts]
-      min_strand = min(to_compare, key=lambda strand: strand.name)
-      poss_starts = filter(lambda i: strands_ext[i + index] == min_strand, poss_starts)
-      index += 1      
-    start = poss_starts[0]
-    return tuple(strands[start:] + strands[:start])
-  def hashable_state(state):
-    filtered = filter(lambda x: x != (), state)
-    return tuple(sorted([hashable_strand_rotation(f) for f in filtered]))
-  def enumerate_states(init_state, reactions, enumerated):
-    """ Enumerates all states reachable from init_state by following any of the
-    strand-list reactions given. The results are stored in <enumerated>.
-    To prevent enumerating past the expected stop conditions,
-    include the stop conditions as the initial value of <enumerated>.
-    Note that <enumerated> is modified in place. """
+def make_multistrand_job(reactants, states, tags, spurious_flags,
+    kinda_params = {}, multistrand_params = {}, multistrand_context = None):
+  """ Creates the Multistrand job simulating the reactions of the given reactants,
+  with one stop condition for each product state, labeled by the corresponding tag. """
+  # Make Macrostates for Multistrand stop conditions
+  stop_conditions = [
+    create_stop_macrostate(state, tag, spurious = spurious_flag, options = kinda_params)
+      for state, tag, spurious_flag
+      in zip(states, tags, spurious_flags)
+    ]
+  
+  # Make Boltzmann sampling selector functions for each reactant
+  start_macrostate_mode = kinda_params.get('start_macrostate_mode', 'ordered-complex')
+  similarity_threshold = kinda_params['multistrand_similarity_threshold']
+  boltzmann_selectors = [
+      create_boltzmann_selector(
+          restingset, 
+          mode = start_macrostate_mode,
+          similarity_threshold = similarity_threshold
+      )
+      for restingset in reactants
+  ]
+
+  # Make Multistrand job
+  cache_dir = kinda_params.get('multistrand_cache_dir')
+  job_params = dict(
+      boltzmann_selectors = boltzmann_selectors,
+      multiprocessing = kinda_params.get('multistrand_multiprocessing', True),
+      multistrand_params = multistrand_params,
+      result_cache = ResultCache(cache_dir) if cache_dir is not None else None,
+      timeout_quantile = kinda_params.get('multistrand_timeout_quantile'),
+      timeout_pilot_sims = kinda_params.get('multistrand_timeout_pilot_sims', 200),
+      max_invalid_records = kinda_params.get('multistrand_max_invalid_records'),
+      invalid_records_policy = kinda_params.get('multistrand_invalid_records_policy', 'reservoir'),
+      multistrand_context = multistrand_context,
+      sims_per_run = kinda_params.get('multistrand_sims_per_run')
+  )
+  if len(reactants) == 2:
+    return FirstStepModeJob(reactants, stop_conditions, **job_params)
+  elif len(reactants) == 1:
+    return FirstPassageTimeModeJob(reactants, stop_conditions,
+        unimolecular_k1_scale = kinda_params['unimolecular_k1_scale'], **job_params)
+
+def make_forward_flux_job(rxn, interface_complex, cutoffs,
+    kinda_params = {}, multistrand_params = {}, multistrand_context = None):
+  """ Creates a ForwardFluxJob estimating the rate of the bimolecular resting-set
+  reaction rxn (e.g. a leak reaction too rare for make_multistrand_job()).
+  The interfaces are COUNT macrostates of interface_complex (typically the
+  product complex) with the given fractional cutoffs, followed by the products
+  of rxn. A trajectory fails when the reactants have dissociated again. """
+  reactants = list(rxn.reactants)
+  assert len(reactants) == 2, "Forward flux sampling requires a bimolecular reaction."
+  interfaces = count_interfaces(interface_complex, cutoffs, name = '{}_interface'.format(rxn))
+  interfaces.append(create_stop_macrostate(list(rxn.products), str(rxn),
+      spurious = False, options = kinda_params))
+  failure_conditions = [create_stop_macrostate(reactants, '_reactants',
+      spurious = False, options = kinda_params)]
+
+  start_macrostate_mode = kinda_params.get('start_macrostate_mode', 'ordered-complex')
+  similarity_threshold = kinda_params['multistrand_similarity_threshold']
+  boltzmann_selectors = [
+      create_boltzmann_selector(
+          restingset,
+          mode = start_macrostate_mode,
+          similarity_threshold = similarity_threshold
+      )
+      for restingset in reactants
+  ]
+  return ForwardFluxJob(reactants, interfaces, failure_conditions,
+      boltzmann_selectors = boltzmann_selectors,
+      multiprocessing = kinda_params.get('multistrand_multiprocessing', True),
+      multistrand_params = multistrand_params,
+      timeout_quantile = kinda_params.get('multistrand_timeout_quantile'),
+      timeout_pilot_sims = kinda_params.get('multistrand_timeout_pilot_sims', 200),
+      multistrand_context = multistrand_context,
+      sims_per_run = kinda_params.get('multistrand_sims_per_run'))
+
+class MultistrandJobFactory(object):
+  """ Creates the Multistrand job shared by the reactions of one reactant group
+  (see make_multistrand_job()) when it is first requested, so that the cost of
+  building stop conditions, Boltzmann selectors and Multistrand objects is only
+  paid for reactions that are actually analyzed. """
+  def __init__(self, reactants, states, tags, spurious_flags, **kargs):
+    self._args = (reactants, states, tags, spurious_flags)
+    self._kargs = kargs
+    self._job = None
+    self._callbacks = []
+
+  @property
+  def created(self):
+    return self._job is not None
+
+  def add_callback(self, func):
+    """ Calls func(job) once the job has been created. """
+    if self._job is not None:
+      func(self._job)
+    else:
+      self._callbacks.append(func)
+
+  def __call__(self):
+    if self._job is None:
+      self._job = make_multistrand_job(*self._args, **self._kargs)
+      for func in self._callbacks:
+        func(self._job)
+      self._callbacks = []
+    return self._job
+
+## Spurious-product analysis. States are tuples of strand lists, in which strands
+## are represented by integer ids ordered like the strand names (see
+## _make_strand_ids()), so that the analysis can run in worker processes and its
+## results do not depend on object identities.
+
+def _hashable_strand_rotation(strands):
+  index = 0
+  poss_starts = range(len(strands))
+  strands_ext = strands + strands
+  while len(poss_starts) > 1 and index < len(strands):
+    to_compare = [strands_ext[i + index] for i in poss_starts]
+    min_strand = min(to_compare)
+    poss_starts = filter(lambda i: strands_ext[i + index] == min_strand, poss_starts)
+    index += 1      
+  start = poss_starts[0]
+  return tuple(strands[start:] + strands[:start])
+
+def _hashable_state(state):
+  filtered = filter(lambda x: x != (), state)
+  return tuple(sorted([_hashable_strand_rotation(f) for f in filtered]))
+
+class _StrandlistNetwork(object):
+  """ The strand-list reactions of a System, indexed by their reactant multisets.
+  Successors of a state by reaction, binding and dissociation are memoized, so
+  the parts of the state space shared by the spurious-product analyses of many
+  reactant groups are only explored once. """
+  def __init__(self, reactions):
+    self._index = {}
+    for reactants, products in reactions:
+      self._index.setdefault(tuple(sorted(reactants)), []).append(list(products))
+    self._max_reactants = max([len(reactants) for reactants in self._index] + [0])
+    self._successors = {}
+    self._bindings = {}
+    self._dissociations = {}
+
+  def successors(self, state):
+    """ Returns the states reached from state by any single reaction. """
+    if state not in self._successors:
+      successors = []
+      for n in range(1, self._max_reactants + 1):
+        # states are sorted, so combinations are sorted like the index keys
+        for reactants in set(it.combinations(state, n)):
+          for products in self._index.get(reactants, []):
+            successors.append(_hashable_state(listminuslist(list(state), reactants) + products))
+      self._successors[state] = successors
+    return self._successors[state]
+
+  def closure(self, init_state, stop_states):
+    """ Returns all states reachable from init_state by following reactions, without
+    continuing past the given stop states, which are included in the result. """
+    enumerated = set(stop_states)
     enumerated.add(init_state)
-    for rxn in reactions:
-      unreacting = listminuslist(list(init_state), rxn[0])
-      if len(unreacting) == len(init_state) - len(rxn[0]): # check that all reactants were present
-        new_state = hashable_state(unreacting + rxn[1])
+    stack = [init_state]
+    while stack:
+      for new_state in self.successors(stack.pop()):
         if new_state not in enumerated:
-          enumerate_states(new_state, reactions, enumerated)
+          enumerated.add(new_state)
+          stack.append(new_state)
     return enumerated
 
-  def binding_spurious_states(init_state, valid_states):
-    """ Return spurious states one step away from given reactants,
-    produced by a binding reaction between two reactants """
-    spurious_states = set([])
-
-    # states produced through binding
-    for r1 in init_state:
-      for r2 in listminuslist(list(init_state), [r1]):
-        rot1 = [r1[i:] + r1[:i] for i in range(len(r1))]
-        rot2 = [r2[i:] + r2[:i] for i in range(len(r2))]
-        unreacting = listminuslist(list(init_state), [r1, r2])
-        spurious_states |= set([hashable_state(unreacting + [a+b]) for a,b in it.product(rot1, rot2)])
-
-    spurious_states = set([s for s in spurious_states if s not in valid_states])
-    return spurious_states
-  def dissociation_spurious_states(init_state, valid_states):
-    """ Return spurious states one step away from given reactants,
-    produced by a dissocation reaction. """
-    spurious_states = set([])
-
-    # states produced through disassociation
-    for r in init_state:
-      unreacting = listminuslist(list(init_state), [r])
-      for i in range(len(r)):
-        for j in range(i, len(r)):
-          new_state = hashable_state(unreacting + [r[i:j], r[j:]+r[:i]])
-          spurious_states.add(new_state)
-
-    spurious_states = set([s for s in spurious_states if s not in valid_states])
-    return spurious_states
-  def one_step_spurious_states(init_state, valid_states):
-    return (binding_spurious_states(init_state, valid_states)
-        | dissociation_spurious_states(init_state, valid_states))
-  def create_restingsets(valid_objects, spurious_strands):
-    strands_to_restingsets = {}
-
-    for strands in spurious_strands:
-      name = ":".join(s.name for s in strands)
-      c = dna.Complex(name = "cpx_" + name, strands = strands)
-      strands_to_restingsets[strands] = dna.RestingSet(name = "rs_" + name, complexes = [c])
-
-    return strands_to_restingsets
-    
-  # Convert to strandlist-level objects
-  strandlist_reactants = hashable_state([tuple(r.strands) for r in reactants])
-  strandlist_reactions = [[[hashable_strand_rotation(r.strands) for r in rxn.reactants],
-                           [hashable_strand_rotation(p.strands) for p in rxn.products]]
-                          for rxn in reactions]
-  strandlist_stop_states = set([hashable_state([tuple(rs.strands) for rs in state])
-                            for state
-                            in stop_states])
-    
+  def bindings(self, state):
+    """ Returns the states produced by a binding reaction between two complexes of state. """
+    if state not in self._bindings:
+      binding_states = set([])
+      for r1 in state:
+        for r2 in listminuslist(list(state), [r1]):
+          rot1 = [r1[i:] + r1[:i] for i in range(len(r1))]
+          rot2 = [r2[i:] + r2[:i] for i in range(len(r2))]
+          unreacting = listminuslist(list(state), [r1, r2])
+          binding_states |= set([_hashable_state(unreacting + [a+b]) for a,b in it.product(rot1, rot2)])
+      self._bindings[state] = binding_states
+    return self._bindings[state]
+
+  def dissociations(self, state):
+    """ Returns the states produced by a dissociation reaction within a complex of state. """
+    if state not in self._dissociations:
+      dissociation_states = set([])
+      for r in state:
+        unreacting = listminuslist(list(state), [r])
+        for i in range(len(r)):
+          for j in range(i, len(r)):
+            dissociation_states.add(_hashable_state(unreacting + [r[i:j], r[j:]+r[:i]]))
+      self._dissociations[state] = dissociation_states
+    return self._dissociations[state]
+
+def _spurious_states(reactants, network, stop_states):
+  """ Returns the sorted list of spurious states for the given strand-list reactants
+  and stop states, in the _StrandlistNetwork network (see get_spurious_products()). """
+  strandlist_reactants = _hashable_state(reactants)
+  strandlist_stop_states = set(_hashable_state(state) for state in stop_states)
+
   # Valid states consist of all states that we explicitly do NOT wish Multistrand to halt on,
   # plus the given expected stop states.
   # This consists of those states that can be enumerated from the initial state by following
   # the given reactions and all states that can be formed from a binding reaction between
   # two reactants in the initial state.
-  valid_states = enumerate_states(strandlist_reactants, strandlist_reactions, strandlist_stop_states.copy()) \
-                 | binding_spurious_states(strandlist_reactants, set([]))
+  valid_states = network.closure(strandlist_reactants, strandlist_stop_states) \
+                 | network.bindings(strandlist_reactants)
 
   # The spurious states are determined as those one step away from
   # intermediate states only.
@@ -275,20 +368,93 @@ def get_spurious_products(reactants, reactions, stop_states):
   # within any valid intermediate state
   spurious_states = set([])
   for state in valid_intermediates:
-    spurious_states |= dissociation_spurious_states(state, valid_states)
+    spurious_states |= network.dissociations(state)
+  return sorted(spurious_states - valid_states)
+
+# Per-process cache of the _StrandlistNetwork built from published reactions
+_networks = {}
+
+def _spurious_states_task((reactants, reactions_key, stop_states)):
+  """ Executor task computing _spurious_states(). The strand-list reactions, which
+  are the same for all tasks, are published once under reactions_key, and indexed
+  once per worker process. """
+  if reactions_key not in _networks:
+    _networks.clear()
+    _networks[reactions_key] = _StrandlistNetwork(executors.fetch_published(reactions_key))
+  return _spurious_states(reactants, _networks[reactions_key], stop_states)
+
+def _make_strand_ids(strands):
+  return {s: i for i, s in enumerate(sorted(set(strands), key = lambda s: (s.name, s.id)))}
+
+def get_spurious_products_all(reactant_groups, reactions, stop_states, executor = None):
+  """ Computes get_spurious_products() for each reactant group in reactant_groups,
+  where stop_states maps each group to its list of stop states. If executor is given,
+  the groups are analyzed concurrently by its workers.
+  Spurious RestingSet objects are created once, in the order of their strand names,
+  and shared between groups, so that repeated runs create identical objects.
+  Returns a dict mapping each reactant group to its list of spurious states. """
+  reactant_groups = list(reactant_groups)
+
+  # Convert to strandlist-level objects
+  strand_ids = _make_strand_ids(
+      [s for rxn in reactions for obj in rxn.reactants + rxn.products for s in obj.strands]
+      + [s for group in reactant_groups for rs in group for s in rs.strands]
+      + [s for group in reactant_groups for state in stop_states[group] for rs in state for s in rs.strands])
+  id_to_strand = {i: s for s, i in strand_ids.iteritems()}
+  def to_strandlist(obj):
+    return tuple(strand_ids[s] for s in obj.strands)
+  strandlist_reactions = [[[_hashable_strand_rotation(to_strandlist(r)) for r in rxn.reactants],
+                           [_hashable_strand_rotation(to_strandlist(p)) for p in rxn.products]]
+                          for rxn in reactions]
+  tasks = [([to_strandlist(r) for r in group],
+            [[to_strandlist(rs) for rs in state] for state in stop_states[group]])
+           for group in reactant_groups]
 
-  # Create RestingSet objects given the strands
-  valid_objects = set(obj for rxn in reactions for obj in rxn.reactants + rxn.products)
-  spurious_strandlists = set(obj for state in spurious_states for obj in state)
-  strands_to_restingsets = create_restingsets(valid_objects, spurious_strandlists)
+  if executor is None or len(reactant_groups) < 2:
+    network = _StrandlistNetwork(strandlist_reactions)
+    results = [_spurious_states(reactants, network, states) for reactants, states in tasks]
+  else:
+    reactions_key = 'spurious_reactions_' + uuid.uuid4().hex
+    executor.publish(reactions_key, strandlist_reactions)
+    task_group = executors.TaskGroup(executor)
+    for i, (reactants, states) in enumerate(tasks):
+      task_group.submit(_spurious_states_task, (reactants, reactions_key, states), tag = i)
+    results = [None] * len(tasks)
+    while task_group.pending > 0:
+      i, result, _, _ = task_group.next_result()
+      results[i] = result
+    executor.unpublish(reactions_key)
+
+  # Create RestingSet objects given the strands, in a deterministic order
+  spurious_strandlists = sorted(set(obj for states in results for state in states for obj in state),
+      key = lambda strandlist: [(id_to_strand[i].name, i) for i in strandlist])
+  strands_to_restingsets = {}
+  for strandlist in spurious_strandlists:
+    strands = [id_to_strand[i] for i in strandlist]
+    name = ":".join(s.name for s in strands)
+    c = dna.Complex(name = "cpx_" + name, strands = strands)
+    strands_to_restingsets[strandlist] = dna.RestingSet(name = "rs_" + name, complexes = [c])
 
   # Convert back to RestingSet objects
-  spurious_restingsets = [
-      [strands_to_restingsets[strands] for strands in state]
-      for state in spurious_states
-  ]
-    
-  return spurious_restingsets
+  return {group: [[strands_to_restingsets[strands] for strands in state] for state in states]
+          for group, states in zip(reactant_groups, results)}
+
+def get_spurious_products(reactants, reactions, stop_states):
+  """ It is desirable to have Multistrand simulations end
+  when interacting complexes have deviated so much from expected
+  trajectories that any calculated reaction times actually
+  include undesired interactions.
+  Complexes along expected reaction trajectories are split up
+  in all possible ways, and expected complexes are disregarded.
+  This produces all unexpected complexes produced 'one step' away
+  from the expected reaction trajectories. Note that complexes 
+  produced by binding of the two reactants in unexpected ways
+  are classified as unproductvie unless they dissociate into an
+  unenumerated strand-level complex, in which case they are
+  considered to be spurious.
+  Use get_spurious_products_all() to analyze many groups of reactants. """
+  reactants = tuple(reactants)
+  return get_spurious_products_all([reactants], reactions, {reactants: stop_states})[reactants]
   
 def create_stop_macrostate(state, tag, spurious, options):
   """ For most simulations, there is a specific way to produce a macrostate
@@ -458,10 +624,95 @@ def calc_unproductive_rxn_score(system_stats, relative_error = 0.5, max_sims = 5
 
 
 
+######################################
+#       Simulation scheduling        #
+######################################
+
+def reduce_rxn_errors(goals, init_batch_size = 50, min_batch_size = 50, 
+    max_batch_size = 500, done_func = None, verbose = 0):
+  """ Runs Multistrand simulations for many reactions at once.
+
+  Each goal is a tuple (rxn_stats, stat, relative_error, max_sims), where rxn_stats is
+  a RestingSetRxnStats object and stat is a statistic name (e.g. 'k1') or a list of
+  names that share the simulation budget max_sims. Simulations of all reactions are
+  interleaved on the shared worker pool until every goal is met or out of budget,
+  rather than reducing the error of one reaction at a time. If done_func is given,
+  it is called as done_func(rxn_stats) whenever a goal that received new results
+  is finished, e.g. to back up the data collected so far.
+  """
+  goal_stats = {}
+  def goal_done_func(goal):
+    done_func(goal_stats[goal])
+
+  scheduler = SimulationScheduler(
+      init_batch_size = init_batch_size,
+      min_batch_size = min_batch_size,
+      max_batch_size = max_batch_size,
+      goal_done_func = goal_done_func if done_func is not None else None,
+      verbose = verbose)
+  for rxn_stats, stat, relative_error, max_sims in goals:
+    goal = scheduler.add_goal(rxn_stats.get_multistrandjob(), rxn_stats.get_multistrand_tag(), 
+        stat, relative_error, max_sims)
+    goal_stats[goal] = rxn_stats
+  scheduler.run()
+
+
+
 ######################################
 #       Import/Export Utilities      #
 ######################################
 
+def journal_key(stats):
+  """ Returns the key under which the simulation results of a RestingSetRxnStats or
+  RestingSetStats object are journaled. Keys depend only on resting set names, so
+  that they still match after the System has been exported and imported. """
+  if isinstance(stats, RestingSetRxnStats):
+    return ('multistrand',) + tuple(sorted(rs.name for rs in stats.reactants))
+  else:
+    return ('nupack', stats.restingset.name)
+
+def _journaled_stats(sstats):
+  stats_by_key = {}
+  for stats in sstats._rxn_to_stats.values():
+    stats_by_key[journal_key(stats)] = stats
+  for stats in sstats._rs_to_stats.values():
+    stats_by_key[journal_key(stats)] = stats
+  return stats_by_key
+
+def attach_journal(sstats, journal):
+  """ Makes every Multistrand and NUPACK job of the System sstats append its results
+  to journal. Multistrand jobs that have not been created yet are attached when
+  they are created. """
+  for key, stats in _journaled_stats(sstats).iteritems():
+    if key[0] == 'multistrand':
+      stats.on_multistrandjob(lambda job, key = key: job.set_journal(journal, key))
+    else:
+      stats.get_nupackjob().set_journal(journal, key)
+
+def attach_result_cache(sstats, result_cache):
+  """ Makes every Multistrand job of the System sstats use result_cache. """
+  for stats in sstats._rxn_to_stats.values():
+    stats.on_multistrandjob(lambda job: job.set_result_cache(result_cache))
+
+def replay_journal(sstats, journal, start = 0):
+  """ Adds the results stored in journal after byte offset start to the jobs of the
+  System sstats. Returns the number of records replayed. """
+  stats_by_key = _journaled_stats(sstats)
+  num_replayed, num_unknown = 0, 0
+  for key, data in journal.records(start):
+    if key not in stats_by_key:
+      num_unknown += 1
+    elif key[0] == 'multistrand':
+      stats_by_key[key].get_multistrandjob().replay_results(data)
+      num_replayed += 1
+    else:
+      stats_by_key[key].get_nupackjob().replay_samples(data)
+      num_replayed += 1
+  if num_unknown:
+    print "# KinDA: WARNING: Skipped {} journal records that do not match any reaction or resting set.".format(num_unknown)
+  return num_replayed
+
+
 def export_data(sstats, filepath, use_pickle = False):
   """ Exports data of this KinDA object so that it can be imported in a later Python session.
   Does not export the entire KinDA object (only the XXXStats data that has been collected).
@@ -539,6 +790,8 @@ def export_data(sstats, filepath, use_pickle = False):
   rsrxnstats_to_dict = {}
   for rsrxn in rs_reactions:
     stats = sstats.get_stats(rsrxn)
+    if not stats.has_multistrandjob():
+      continue # never analyzed, so there is no data to export
     sim_data = {key: d.tolist() for key,d in stats.get_simulation_data().iteritems()}
     if len(rsrxn.reactants) == 2:
       rsrxnstats_to_dict[rsrxn_to_id[rsrxn]] = {
@@ -547,7 +800,8 @@ def export_data(sstats, filepath, use_pickle = False):
         'k1': '{0} +/- {1}'.format(stats.get_k1(max_sims = 0), stats.get_k1_error(max_sims=0)),
         'k2': '{0} +/- {1}'.format(stats.get_k2(max_sims = 0), stats.get_k2_error(max_sims=0)),
         'simulation_data': sim_data,
-        'invalid_simulation_data': stats.get_invalid_simulation_data(),
+        'invalid_simulation_data': stats.get_multistrandjob().invalid_records.to_dict(),
+        'timeout_calibration': stats.get_multistrandjob().timeout_calibration,
         'tag': stats.multijob_tag
       }
     elif len(rsrxn.reactants) == 1:
@@ -556,7 +810,8 @@ def export_data(sstats, filepath, use_pickle = False):
         'k1': '{0} +/- {1}'.format(stats.get_k1(max_sims = 0), stats.get_k1_error(max_sims=0)),
         'k2': '{0} +/- {1}'.format(stats.get_k2(max_sims = 0), stats.get_k2_error(max_sims=0)),
         'simulation_data': sim_data,
-        'invalid_simulation_data': stats.get_invalid_simulation_data(),
+        'invalid_simulation_data': stats.get_multistrandjob().invalid_records.to_dict(),
+        'timeout_calibration': stats.get_multistrandjob().timeout_calibration,
         'tag': stats.multijob_tag
       }
 
@@ -573,6 +828,9 @@ def export_data(sstats, filepath, use_pickle = False):
     'initialization_params': sstats.initialization_params,
     'version': KINDA_VERSION
   }
+  if sstats.journal is not None:
+    # Records appended after this offset are not part of the exported data
+    sstats_dict['journal'] = {'path': sstats.journal.filepath, 'offset': sstats.journal.offset}
   
   if use_pickle : 
     pickle.dump(sstats_dict, open(filepath, "wb"))
@@ -686,11 +944,14 @@ def import_data(filepath, use_pickle = False):
     multijob = stats.get_multistrandjob()
     stats.multijob_tag = data['tag']
 
-    num_sims = len(data['simulation_data']['tags'])
     sim_data = {key:np.array(d) for key,d in data['simulation_data'].iteritems()}
     multijob.set_simulation_data(sim_data)
     multijob.set_invalid_simulation_data(data['invalid_simulation_data'])
-    multijob.total_sims = num_sims
+    if data.get('timeout_calibration') is not None:
+      multijob.set_timeout_calibration(data['timeout_calibration'])
+
+  if 'journal' in sstats_dict:
+    sstats._journal_position = (sstats_dict['journal']['path'], sstats_dict['journal']['offset'])
     
   return sstats
 